@@ -1,15 +1,33 @@
 from __future__ import annotations
 
-import json
+import asyncio
+import inspect
+import re
+import sys
 from abc import ABC, abstractmethod
-from typing import Any, Dict, Generator, List, Tuple
+from dataclasses import dataclass, field
+from typing import Any, AsyncGenerator, Callable, Dict, Generator, List, Optional, Tuple
 
 from app import prompts as prompt_builders
-from app.llm_client import LLMClient
+from app.llm_client import LLMClient, coalesce_chunks, coalesce_chunks_async, iterate_in_thread
+from app.state import CombinedResult, FinalResult, IntakeResult, RouteDecision, SpecialistResult
 
+# 可选：在 LangGraph 节点内运行时，通过 custom stream 把已生成完的字段提前推给前端
+# （main.py 直接调用智能体，不在 LangGraph 上下文中，只有显式传入 on_field 才会逐字段推送）
 try:
-    from app.utils import render_final_reply, route_fallback
+    from langgraph.config import get_stream_writer
+except ImportError:
+    get_stream_writer = None  # type: ignore[assignment]
+
+try:
+    from app.utils import RED_FLAG_TAG, render_final_reply, route_fallback, scan_keyword_tags
 except Exception:
+    RED_FLAG_TAG = "red_flag"
+    _RED_FLAG_RE = re.compile("胸痛|呼吸困难|意识不清|昏迷|抽搐|咯血|高热不退")
+
+    def scan_keyword_tags(text: str) -> frozenset:
+        return frozenset((RED_FLAG_TAG,)) if _RED_FLAG_RE.search(text) else frozenset()
+
     def route_fallback(_: Dict[str, Any]) -> str:
         return "全科"
 
@@ -19,23 +37,34 @@ except Exception:
 
 
 def _safe_text(value: Any, default: str = "") -> str:
-    if value is None:
+    # 模型输出绝大多数是 str，先走精确类型判断，省掉 str() 调用
+    if type(value) is str:
+        text = value.strip()
+    elif value is None:
         return default
-    text = str(value).strip()
-    return text if text else default
+    else:
+        text = str(value).strip()
+    return text or default
 
 
 def _to_str_list(value: Any, max_items: int = 20) -> List[str]:
     if not isinstance(value, list):
         return []
 
+    seen = set()
     result: List[str] = []
     for item in value:
-        text = _safe_text(item)
-        if text and text not in result:
+        if type(item) is str:
+            text = item.strip()
+        elif item is None:
+            continue
+        else:
+            text = str(item).strip()
+        if text and text not in seen:
+            seen.add(text)
             result.append(text)
-        if len(result) >= max_items:
-            break
+            if len(result) >= max_items:
+                break
     return result
 
 
@@ -58,6 +87,12 @@ def _to_optional_float(value: Any) -> float | None:
         return None
 
 
+def _get_typed(state: Dict[str, Any], key: str, expected_type: type, default: Any) -> Any:
+    """只查一次 state，类型不符时返回默认值。"""
+    value = state.get(key)
+    return value if isinstance(value, expected_type) else default
+
+
 def _has_value(value: Any) -> bool:
     if value is None:
         return False
@@ -68,38 +103,112 @@ def _has_value(value: Any) -> bool:
     return True
 
 
+def _canonical_patient_info(patient_info: Dict[str, Any]) -> Dict[str, Any]:
+    """键排序、列表值排序，保证语义相同的病历序列化后完全一致（利于缓存命中）。"""
+    canonical: Dict[str, Any] = {}
+    for key in sorted(patient_info):
+        value = patient_info[key]
+        canonical[key] = sorted(_to_str_list(value)) if isinstance(value, list) else value
+    return canonical
+
+
+_NON_SPACE_RE = re.compile(r"\S")
+
+
 def _build_document_context(documents_text: Any, max_chars: int = 3000) -> str:
+    # 边拼接边扣减额度，超长材料只切取需要的前缀，不先拼出完整大文本
     if not isinstance(documents_text, list):
         return "无上传参考材料"
 
-    blocks: List[str] = []
+    parts: List[str] = []
+    remaining = max_chars
+    found = False
     for idx, item in enumerate(documents_text, start=1):
-        text = _safe_text(item)
-        if text:
-            blocks.append(f"参考材料{idx}:\n{text}")
-
-    if not blocks:
-        return "无上传参考材料"
-
-    merged = "\n\n".join(blocks)
-    return merged[:max_chars]
+        if item is None:
+            continue
+        raw = item if type(item) is str else str(item)
+        start = _NON_SPACE_RE.search(raw)
+        if start is None:
+            continue
+        header = f"\n\n参考材料{idx}:\n" if found else f"参考材料{idx}:\n"
+        found = True
+        if remaining <= 0:
+            break
 
+        parts.append(header[:remaining])
+        remaining -= len(header)
+        if remaining <= 0:
+            break
 
-def _history_to_text(history: List[Dict[str, Any]], user_input: str, max_turns: int = 20) -> str:
-    lines: List[str] = []
-    sliced = history[-max_turns:] if isinstance(history, list) else []
+        stop = len(raw)
+        while raw[stop - 1].isspace():
+            stop -= 1
+        body = raw[start.start() : min(stop, start.start() + remaining)]
+        parts.append(body)
+        remaining -= len(body)
 
-    for item in sliced:
-        if not isinstance(item, dict):
+    if not found:
+        return "无上传参考材料"
+    return "".join(parts)
+
+
+def _resolve_document_context(state: Dict[str, Any]) -> str:
+    """优先复用 Intake 阶段已计算好的 _document_context，未命中时再现场构建。"""
+    cached = state.get("_document_context")
+    if isinstance(cached, str) and cached:
+        return cached
+    return _build_document_context(state.get("documents_text", []))
+
+
+def _format_history_item(item: Any) -> str:
+    if not isinstance(item, dict):
+        return ""
+    content = _safe_text(item.get("content"))
+    if not content:
+        return ""
+    return f"{_safe_text(item.get('role'), 'unknown')}: {content}"
+
+
+def _history_lines(history: List[Dict[str, Any]], cached_lines: Any = None) -> List[str]:
+    """
+    history 只追加、不修改，因此按下标缓存每条消息格式化后的行（无内容的消息记为 ""）。
+    每轮只需格式化上次缓存之后新增的消息；缓存比 history 长说明会话已重置，整体重建。
+    没有新增消息时直接返回缓存列表本身；有新增时只拼接一次，不原地修改缓存（回滚时旧列表仍然有效）。
+    """
+    if isinstance(cached_lines, list) and len(cached_lines) <= len(history):
+        if len(cached_lines) == len(history):
+            return cached_lines
+        return cached_lines + [_format_history_item(item) for item in history[len(cached_lines):]]
+    return [_format_history_item(item) for item in history]
+
+
+def _history_to_text(
+    history: List[Dict[str, Any]],
+    user_input: str,
+    max_turns: int = 20,
+    lines: List[str] | None = None,
+    char_budget: int = 6000,
+) -> str:
+    """最近 max_turns 条历史中，再按字符预算从新到旧截取；最新一条过长时截断保留开头。"""
+    if not isinstance(history, list):
+        history = []
+    if lines is None:
+        lines = _history_lines(history)
+
+    kept: List[str] = []
+    used = 0
+    for line in reversed(lines[-max_turns:]):
+        if not line:
             continue
-        role = _safe_text(item.get("role"), "unknown")
-        content = _safe_text(item.get("content"))
-        if content:
-            lines.append(f"{role}: {content}")
+        used += len(line) + 1
+        if used > char_budget and kept:
+            break
+        kept.append(line if used <= char_budget else line[:char_budget])
+    lines = kept[::-1]
 
     append_user = bool(user_input)
-    if append_user and sliced:
-        last = sliced[-1]
+    if append_user and history:
+        last = history[-1]
         if isinstance(last, dict):
             if _safe_text(last.get("role")) == "user" and _safe_text(last.get("content")) == user_input:
                 append_user = False
@@ -110,18 +219,207 @@ def _history_to_text(history: List[Dict[str, Any]], user_input: str, max_turns:
     return "\n".join(lines).strip()
 
 
+# 总结回复提示词中的字段 -> 中文标签；按此顺序输出，未列出的字段不进入提示词
+_COMPACT_LABELS: Tuple[Tuple[str, Tuple[Tuple[str, str], ...]], ...] = (
+    (
+        "patient_info",
+        (
+            ("age", "年龄"),
+            ("sex", "性别"),
+            ("chief_complaint", "主诉"),
+            ("duration", "持续时间"),
+            ("severity", "严重程度"),
+            ("symptoms", "伴随症状"),
+            ("allergies", "过敏史"),
+            ("chronic_diseases", "慢性病"),
+            ("current_meds", "当前用药"),
+            ("additional_notes", "补充信息"),
+        ),
+    ),
+    (
+        "route",
+        (
+            ("department", "分诊科室"),
+            ("reason", "分诊理由"),
+        ),
+    ),
+    (
+        "specialist_result",
+        (
+            ("preliminary_assessment", "专科初步评估"),
+            ("possible_diagnoses", "可能诊断"),
+            ("recommended_checks", "建议检查"),
+            ("medication_suggestions", "可讨论用药"),
+            ("risk_alerts", "风险提示"),
+        ),
+    ),
+    (
+        "final_result",
+        (
+            ("diagnosis_summary", "初步判断"),
+            ("prescription_advice", "用药方向"),
+            ("home_care", "居家护理"),
+            ("follow_up", "复诊建议"),
+            ("emergency_signs", "立即就医信号"),
+            ("disclaimer", "免责声明"),
+        ),
+    ),
+)
+_SEX_LABELS = {"male": "男", "female": "女", "other": "其他"}
+
+
+def _compact_value(key: str, value: Any) -> str:
+    if key == "sex":
+        return _SEX_LABELS.get(_safe_text(value), _safe_text(value))
+    if key == "medication_suggestions" and isinstance(value, list):
+        parts = []
+        for item in value:
+            if not isinstance(item, dict):
+                continue
+            name = _safe_text(item.get("name"))
+            if not name:
+                continue
+            purpose = _safe_text(item.get("purpose"))
+            otc = "OTC" if _as_bool(item.get("otc")) else "需医生评估"
+            parts.append(f"{name}（{purpose}，{otc}）" if purpose else f"{name}（{otc}）")
+        return "；".join(parts)
+    if isinstance(value, list):
+        return "、".join(_to_str_list(value))
+    return _safe_text(value)
+
+
+def _compact_render(payload: Dict[str, Any]) -> str:
+    """把结构化结果渲染成“标签: 值”行，跳过空字段，比 JSON 省去键名/引号/括号的 token。"""
+    lines: List[str] = []
+    for section, labels in _COMPACT_LABELS:
+        data = payload.get(section)
+        if not isinstance(data, dict):
+            continue
+        for key, label in labels:
+            text = _compact_value(key, data.get(key))
+            if text:
+                lines.append(f"{label}: {text}")
+
+    reference = _safe_text(payload.get("uploaded_reference"))
+    if reference:
+        lines.append(f"上传材料:\n{reference}")
+    return "\n".join(lines)
+
+
+# 总结回复（流式）兜底提示词的静态部分，只在导入时构建一次
+_SUMMARY_REPLY_SYSTEM = (
+    "你是医疗问诊总结助手。"
+    "请基于结构化信息输出最终患者可读回复。"
+    "要求：中文、清晰、可执行；不要输出JSON；"
+    "不要给药物剂量/频次/疗程。"
+)
+_SUMMARY_REPLY_DIRECTIVE = (
+    "请按以下结构输出：\n"
+    "【初步判断】\n【可与医生讨论的用药方向】\n【居家护理】\n"
+    "【复诊建议】\n【立即就医信号】\n【免责声明】\n\n"
+    "如上传材料与用户最新主诉冲突，以最新主诉为准。\n\n"
+    "结构化输入：\n"
+)
+
+
 def _has_red_flag(patient_info: Dict[str, Any]) -> bool:
-    text_parts = [
-        _safe_text(patient_info.get("chief_complaint")),
-        _safe_text(patient_info.get("additional_notes")),
-        " ".join(_to_str_list(patient_info.get("symptoms"))),
-    ]
-    merged_text = " ".join(text_parts).lower()
-    red_flags = ["胸痛", "呼吸困难", "意识不清", "昏迷", "抽搐", "咯血", "高热不退"]
-    return any(flag in merged_text for flag in red_flags)
+    # 共用 utils 中编译好的关键词扫描器，一次扫描得到全部命中标签
+    merged_text = " ".join(
+        (
+            _safe_text(patient_info.get("chief_complaint")),
+            _safe_text(patient_info.get("additional_notes")),
+            " ".join(_to_str_list(patient_info.get("symptoms"))),
+        )
+    )
+    return RED_FLAG_TAG in scan_keyword_tags(merged_text)
+
+
+def _current_stream_writer() -> Optional[Callable[[Any], None]]:
+    if get_stream_writer is None:
+        return None
+    try:
+        return get_stream_writer()
+    except RuntimeError:
+        # 不在 LangGraph 运行上下文中（例如 main.py 直接调用智能体）
+        return None
+
+
+PromptBuilder = Callable[..., Tuple[str, str]]
+
+
+def _bind_prompt_builder(
+    builder: Any,
+    keyword_names: Tuple[str, ...],
+    positional_names: Tuple[str, ...],
+) -> Optional[PromptBuilder]:
+    """
+    导入时一次性解析 prompt builder 的签名，返回统一用关键字参数调用的函数：
+    - builder 接受全部关键字参数时直接返回
+    - 否则按旧版签名的位置参数调用（丢弃旧版不支持的参数）
+    避免每轮都走 try/except TypeError。
+    """
+    if not callable(builder):
+        return None
+
+    try:
+        params = inspect.signature(builder).parameters
+    except (TypeError, ValueError):
+        return builder
+
+    has_var_kwargs = any(p.kind is inspect.Parameter.VAR_KEYWORD for p in params.values())
+    if has_var_kwargs or all(name in params for name in keyword_names):
+        return builder
+
+    def _positional(**kwargs: Any) -> Tuple[str, str]:
+        return builder(*(kwargs[name] for name in positional_names))
+
+    return _positional
+
+
+_INTAKE_PROMPT_BUILDER = _bind_prompt_builder(
+    prompt_builders.build_intake_prompts,
+    ("history_text", "existing_info", "document_context"),
+    ("history_text", "existing_info"),
+)
+_ROUTER_PROMPT_BUILDER = _bind_prompt_builder(
+    prompt_builders.build_router_prompts,
+    ("patient_info", "document_context"),
+    ("patient_info",),
+)
+_SPECIALIST_PROMPT_BUILDER = _bind_prompt_builder(
+    prompt_builders.build_specialist_prompts,
+    ("department", "patient_info", "route", "document_context"),
+    ("department", "patient_info", "route"),
+)
+_SUMMARY_PROMPT_BUILDER = _bind_prompt_builder(
+    prompt_builders.build_summary_prompts,
+    ("patient_info", "route", "specialist_result", "document_context"),
+    ("patient_info", "route", "specialist_result"),
+)
+_SUMMARY_REPLY_PROMPT_BUILDER = _bind_prompt_builder(
+    getattr(prompt_builders, "build_summary_reply_prompts", None),
+    ("patient_info", "route", "specialist_result", "final_result", "document_context"),
+    ("patient_info", "route", "specialist_result", "final_result"),
+)
+
+
+@dataclass(frozen=True)
+class AgentRequest:
+    """一次 LLM 调用的提示词，以及解析结果时需要复用的中间值。"""
+    system_prompt: str
+    user_prompt: str
+    context: Dict[str, Any] = field(default_factory=dict)
 
 
 class BaseAgent(ABC):
+    MAX_TOKENS = 1600
+    # 模型原始输出的结构（TypedDict），供 chat_json 做快速解析校验
+    RESULT_SCHEMA: Any = None
+    # 是否允许 chat_json 走语义缓存（近似提示词复用结果），只对可容忍近似命中的分诊调用开启
+    SEMANTIC_CACHE = False
+    # 是否在有字段接收方时改用 chat_json_stream，逐个推送已完成的顶层字段
+    STREAM_FIELDS = False
+
     def __init__(self, llm: LLMClient) -> None:
         self.llm = llm
 
@@ -129,26 +427,88 @@ class BaseAgent(ABC):
         return self.run(state)
 
     @abstractmethod
-    def run(self, state: Dict[str, Any]) -> Dict[str, Any]:
+    def build_request(self, state: Dict[str, Any]) -> AgentRequest:
         raise NotImplementedError
 
+    @abstractmethod
+    def apply_result(
+        self,
+        state: Dict[str, Any],
+        raw_result: Dict[str, Any],
+        context: Dict[str, Any],
+    ) -> Dict[str, Any]:
+        raise NotImplementedError
+
+    def _request_raw(
+        self,
+        request: AgentRequest,
+        on_field: Optional[Callable[[Dict[str, Any]], None]] = None,
+    ) -> Dict[str, Any]:
+        """
+        取模型原始 JSON：
+        - 有字段接收方（显式 on_field，或 STREAM_FIELDS 且处于 LangGraph 节点中）时走流式，
+          每个顶层字段完成即推送 {"agent", "field", "value"}
+        - 否则一次性 chat_json
+        """
+        sink = on_field or (_current_stream_writer() if self.STREAM_FIELDS else None)
+        if sink is None:
+            return self.llm.chat_json(
+                request.system_prompt,
+                request.user_prompt,
+                max_tokens=self.MAX_TOKENS,
+                schema=self.RESULT_SCHEMA,
+                semantic_cache=self.SEMANTIC_CACHE,
+            )
+
+        raw_result: Dict[str, Any] = {}
+        agent_name = type(self).__name__
+        for key, value in self.llm.chat_json_stream(
+            request.system_prompt,
+            request.user_prompt,
+            max_tokens=self.MAX_TOKENS,
+            schema=self.RESULT_SCHEMA,
+        ):
+            raw_result[key] = value
+            sink({"agent": agent_name, "field": key, "value": value})
+        return raw_result
+
+    def run(self, state: Dict[str, Any]) -> Dict[str, Any]:
+        request = self.build_request(state)
+        raw_result = self._request_raw(request)
+        return self.apply_result(state, raw_result or {}, request.context)
+
+    async def run_async(self, state: Dict[str, Any]) -> Dict[str, Any]:
+        return await asyncio.to_thread(self.run, state)
+
+    def run_batch(self, states: List[Dict[str, Any]], **batch_kwargs: Any) -> List[Dict[str, Any]]:
+        """
+        离线批量运行（评测 / 批量回放）：
+        所有 state 的请求合并为一个 Batch API 任务提交，结果再逐个走原有的归一化逻辑。
+        实时会话请继续使用 run。
+        """
+        requests = [self.build_request(state) for state in states]
+        raw_results = self.llm.chat_json_batch(
+            [(request.system_prompt, request.user_prompt) for request in requests],
+            max_tokens=self.MAX_TOKENS,
+            schema=self.RESULT_SCHEMA,
+            **batch_kwargs,
+        )
+        return [
+            self.apply_result(state, raw_result or {}, request.context)
+            for state, request, raw_result in zip(states, requests, raw_results)
+        ]
+
 
 class IntakeAgent(BaseAgent):
-    REQUIRED_FIELDS = ("chief_complaint", "duration", "severity")
-    LIST_FIELDS = ("symptoms", "allergies", "chronic_diseases", "current_meds")
-    SCALAR_FIELDS = ("age", "sex", "chief_complaint", "duration", "severity", "additional_notes")
-    KNOWN_FIELDS = {
-        "age",
-        "sex",
-        "chief_complaint",
-        "duration",
-        "severity",
-        "symptoms",
-        "allergies",
-        "chronic_diseases",
-        "current_meds",
-        "additional_notes",
-    }
+    RESULT_SCHEMA = IntakeResult
+    # 不走语义缓存：近似病史（如“头疼三天”与“头疼五天”）会把别的会话的病程/症状当成本次抽取结果
+    SEMANTIC_CACHE = False
+    REQUIRED_FIELDS = tuple(map(sys.intern, ("chief_complaint", "duration", "severity")))
+    LIST_FIELDS = tuple(map(sys.intern, ("symptoms", "allergies", "chronic_diseases", "current_meds")))
+    SCALAR_FIELDS = tuple(
+        map(sys.intern, ("age", "sex", "chief_complaint", "duration", "severity", "additional_notes"))
+    )
+    KNOWN_FIELDS = frozenset(SCALAR_FIELDS + LIST_FIELDS)
 
     @staticmethod
     def _build_prompts(
@@ -156,14 +516,11 @@ class IntakeAgent(BaseAgent):
         existing_info: Dict[str, Any],
         document_context: str,
     ) -> Tuple[str, str]:
-        try:
-            return prompt_builders.build_intake_prompts(
-                history_text=history_text,
-                existing_info=existing_info,
-                document_context=document_context,
-            )
-        except TypeError:
-            return prompt_builders.build_intake_prompts(history_text, existing_info)
+        return _INTAKE_PROMPT_BUILDER(
+            history_text=history_text,
+            existing_info=existing_info,
+            document_context=document_context,
+        )
 
     def _normalize_patient_info(
         self,
@@ -203,18 +560,12 @@ class IntakeAgent(BaseAgent):
             if age_value is not None:
                 merged["age"] = age_value
 
+        # 每个字段只清洗一次：本轮有新值用新值，否则清洗沿用的旧值
         for field in ("sex", "chief_complaint", "duration", "severity", "additional_notes"):
-            if field in source:
-                merged[field] = _safe_text(source.get(field))
+            merged[field] = _safe_text(source[field] if field in source else merged.get(field))
 
         for field in self.LIST_FIELDS:
-            if field in source:
-                merged[field] = _to_str_list(source.get(field))
-            else:
-                merged[field] = _to_str_list(merged.get(field))
-
-        for field in ("sex", "chief_complaint", "duration", "severity", "additional_notes"):
-            merged[field] = _safe_text(merged.get(field))
+            merged[field] = _to_str_list(source[field] if field in source else merged.get(field))
 
         return merged
 
@@ -251,19 +602,40 @@ class IntakeAgent(BaseAgent):
 
         return questions[:8]
 
-    def run(self, state: Dict[str, Any]) -> Dict[str, Any]:
-        history = list(state.get("history", [])) if isinstance(state.get("history"), list) else []
-        existing_info = state.get("patient_info", {}) if isinstance(state.get("patient_info"), dict) else {}
+    def build_request(self, state: Dict[str, Any]) -> AgentRequest:
+        history = list(_get_typed(state, "history", list, []))
+        existing_info = _get_typed(state, "patient_info", dict, {})
         user_input = _safe_text(state.get("user_input"))
+        # Intake 是每轮入口：documents_text 可能刚更新，这里总是重新构建并写回 state
         document_context = _build_document_context(state.get("documents_text", []))
-        history_text = _history_to_text(history, user_input)
+        history_lines = _history_lines(history, state.get("_history_lines"))
+        history_text = _history_to_text(history, user_input, lines=history_lines)
 
         system_prompt, user_prompt = self._build_prompts(
             history_text=history_text,
             existing_info=existing_info,
             document_context=document_context,
         )
-        raw_result = self.llm.chat_json(system_prompt, user_prompt) or {}
+        return AgentRequest(
+            system_prompt,
+            user_prompt,
+            {
+                "history": history,
+                "history_lines": history_lines,
+                "existing_info": existing_info,
+                "document_context": document_context,
+            },
+        )
+
+    def apply_result(
+        self,
+        state: Dict[str, Any],
+        raw_result: Dict[str, Any],
+        context: Dict[str, Any],
+    ) -> Dict[str, Any]:
+        history = context["history"]
+        existing_info = context["existing_info"]
+        document_context = context["document_context"]
 
         patient_info = self._normalize_patient_info(raw_result.get("patient_info"), existing_info)
         missing_fields = self._normalize_missing_fields(raw_result.get("missing_fields"), patient_info)
@@ -286,8 +658,9 @@ class IntakeAgent(BaseAgent):
             if not missing_questions:
                 missing_questions = ["请补充主要不适、持续时间和严重程度。"]
 
-            lines = [f"{index + 1}. {question}" for index, question in enumerate(missing_questions)]
-            assistant_reply = "为了更准确地判断，请补充以下信息：\n" + "\n".join(lines)
+            assistant_reply = "为了更准确地判断，请补充以下信息：\n" + "\n".join(
+                f"{index}. {question}" for index, question in enumerate(missing_questions, start=1)
+            )
             next_action = "ask_user_more"
 
         history.append({"role": "assistant", "content": assistant_reply})
@@ -302,29 +675,31 @@ class IntakeAgent(BaseAgent):
             },
             "assistant_reply": assistant_reply,
             "next_action": next_action,
+            "_document_context": document_context,
+            "_history_lines": context["history_lines"],
         }
 
 
 class RouterAgent(BaseAgent):
-    VALID_DEPARTMENTS = {"呼吸科", "心血管科", "消化内科", "全科"}
+    RESULT_SCHEMA = RouteDecision
+    SEMANTIC_CACHE = True
+    VALID_DEPARTMENTS = frozenset(map(sys.intern, ("呼吸科", "心血管科", "消化内科", "全科")))
 
     @staticmethod
     def _build_prompts(patient_info: Dict[str, Any], document_context: str) -> Tuple[str, str]:
-        try:
-            return prompt_builders.build_router_prompts(
-                patient_info=patient_info,
-                document_context=document_context,
-            )
-        except TypeError:
-            return prompt_builders.build_router_prompts(patient_info)
-
-    def run(self, state: Dict[str, Any]) -> Dict[str, Any]:
-        history = list(state.get("history", [])) if isinstance(state.get("history"), list) else []
-        patient_info = state.get("patient_info", {}) if isinstance(state.get("patient_info"), dict) else {}
-        document_context = _build_document_context(state.get("documents_text", []))
+        return _ROUTER_PROMPT_BUILDER(
+            patient_info=patient_info,
+            document_context=document_context,
+        )
 
-        system_prompt, user_prompt = self._build_prompts(patient_info, document_context)
-        raw_result = self.llm.chat_json(system_prompt, user_prompt) or {}
+    def _normalize_route(
+        self,
+        raw_result: Dict[str, Any],
+        patient_info: Dict[str, Any],
+        document_context: str,
+    ) -> Dict[str, Any]:
+        if not isinstance(raw_result, dict):
+            raw_result = {}
 
         department = _safe_text(raw_result.get("department"))
         reason = _safe_text(raw_result.get("reason"))
@@ -352,6 +727,29 @@ class RouterAgent(BaseAgent):
         }
         if confidence is not None:
             route["confidence"] = confidence
+        return route
+
+    def build_request(self, state: Dict[str, Any]) -> AgentRequest:
+        patient_info = _get_typed(state, "patient_info", dict, {})
+        document_context = _resolve_document_context(state)
+
+        system_prompt, user_prompt = self._build_prompts(_canonical_patient_info(patient_info), document_context)
+        return AgentRequest(
+            system_prompt,
+            user_prompt,
+            {"patient_info": patient_info, "document_context": document_context},
+        )
+
+    def apply_result(
+        self,
+        state: Dict[str, Any],
+        raw_result: Dict[str, Any],
+        context: Dict[str, Any],
+    ) -> Dict[str, Any]:
+        history = list(_get_typed(state, "history", list, []))
+        route = self._normalize_route(raw_result, context["patient_info"], context["document_context"])
+        department = route["department"]
+        reason = route["reason"]
 
         assistant_reply = f"分诊结果：{department}。理由：{reason}。正在进入专科分析。"
         history.append({"role": "assistant", "content": assistant_reply})
@@ -365,6 +763,9 @@ class RouterAgent(BaseAgent):
 
 
 class SpecialistAgent(BaseAgent):
+    RESULT_SCHEMA = SpecialistResult
+    STREAM_FIELDS = True
+
     @staticmethod
     def _build_prompts(
         department: str,
@@ -372,15 +773,12 @@ class SpecialistAgent(BaseAgent):
         route: Dict[str, Any],
         document_context: str,
     ) -> Tuple[str, str]:
-        try:
-            return prompt_builders.build_specialist_prompts(
-                department=department,
-                patient_info=patient_info,
-                route=route,
-                document_context=document_context,
-            )
-        except TypeError:
-            return prompt_builders.build_specialist_prompts(department, patient_info, route)
+        return _SPECIALIST_PROMPT_BUILDER(
+            department=department,
+            patient_info=patient_info,
+            route=route,
+            document_context=document_context,
+        )
 
     def _normalize_specialist_result(
         self,
@@ -433,21 +831,35 @@ class SpecialistAgent(BaseAgent):
             "risk_alerts": risk_alerts,
         }
 
-    def run(self, state: Dict[str, Any]) -> Dict[str, Any]:
-        history = list(state.get("history", [])) if isinstance(state.get("history"), list) else []
-        patient_info = state.get("patient_info", {}) if isinstance(state.get("patient_info"), dict) else {}
-        route = state.get("route", {}) if isinstance(state.get("route"), dict) else {}
+    def build_request(self, state: Dict[str, Any]) -> AgentRequest:
+        patient_info = _get_typed(state, "patient_info", dict, {})
+        route = _get_typed(state, "route", dict, {})
         department = _safe_text(route.get("department"), "全科")
-        document_context = _build_document_context(state.get("documents_text", []))
+        document_context = _resolve_document_context(state)
 
         system_prompt, user_prompt = self._build_prompts(
             department=department,
-            patient_info=patient_info,
+            patient_info=_canonical_patient_info(patient_info),
             route=route,
             document_context=document_context,
         )
-        raw_result = self.llm.chat_json(system_prompt, user_prompt) or {}
-        specialist_result = self._normalize_specialist_result(raw_result, patient_info, document_context)
+        return AgentRequest(
+            system_prompt,
+            user_prompt,
+            {"patient_info": patient_info, "department": department, "document_context": document_context},
+        )
+
+    def apply_result(
+        self,
+        state: Dict[str, Any],
+        raw_result: Dict[str, Any],
+        context: Dict[str, Any],
+    ) -> Dict[str, Any]:
+        history = list(_get_typed(state, "history", list, []))
+        department = context["department"]
+        specialist_result = self._normalize_specialist_result(
+            raw_result, context["patient_info"], context["document_context"]
+        )
 
         assistant_reply = f"{department}专科已完成初步评估，正在生成最终总结。"
         history.append({"role": "assistant", "content": assistant_reply})
@@ -461,6 +873,9 @@ class SpecialistAgent(BaseAgent):
 
 
 class SummaryAgent(BaseAgent):
+    RESULT_SCHEMA = FinalResult
+    STREAM_FIELDS = True
+
     @staticmethod
     def _build_summary_prompts(
         patient_info: Dict[str, Any],
@@ -468,15 +883,12 @@ class SummaryAgent(BaseAgent):
         specialist_result: Dict[str, Any],
         document_context: str,
     ) -> Tuple[str, str]:
-        try:
-            return prompt_builders.build_summary_prompts(
-                patient_info=patient_info,
-                route=route,
-                specialist_result=specialist_result,
-                document_context=document_context,
-            )
-        except TypeError:
-            return prompt_builders.build_summary_prompts(patient_info, route, specialist_result)
+        return _SUMMARY_PROMPT_BUILDER(
+            patient_info=patient_info,
+            route=route,
+            specialist_result=specialist_result,
+            document_context=document_context,
+        )
 
     @staticmethod
     def _build_summary_reply_prompts_fallback(
@@ -486,13 +898,6 @@ class SummaryAgent(BaseAgent):
         final_result: Dict[str, Any],
         document_context: str,
     ) -> Tuple[str, str]:
-        system_prompt = (
-            "你是医疗问诊总结助手。"
-            "请基于结构化信息输出最终患者可读回复。"
-            "要求：中文、清晰、可执行；不要输出JSON；"
-            "不要给药物剂量/频次/疗程。"
-        )
-
         payload = {
             "patient_info": patient_info,
             "route": route,
@@ -500,14 +905,7 @@ class SummaryAgent(BaseAgent):
             "final_result": final_result,
             "uploaded_reference": document_context,
         }
-        user_prompt = (
-            "请按以下结构输出：\n"
-            "【初步判断】\n【可与医生讨论的用药方向】\n【居家护理】\n"
-            "【复诊建议】\n【立即就医信号】\n【免责声明】\n\n"
-            "如上传材料与用户最新主诉冲突，以最新主诉为准。\n\n"
-            f"结构化输入：{json.dumps(payload, ensure_ascii=False)}"
-        )
-        return system_prompt, user_prompt
+        return _SUMMARY_REPLY_SYSTEM, _SUMMARY_REPLY_DIRECTIVE + _compact_render(payload)
 
     def _normalize_final_result(
         self,
@@ -557,13 +955,11 @@ class SummaryAgent(BaseAgent):
             "disclaimer": disclaimer,
         }
 
-    def prepare(self, state: Dict[str, Any]) -> Dict[str, Any]:
-        patient_info = state.get("patient_info", {}) if isinstance(state.get("patient_info"), dict) else {}
-        route = state.get("route", {}) if isinstance(state.get("route"), dict) else {}
-        specialist_result = (
-            state.get("specialist_result", {}) if isinstance(state.get("specialist_result"), dict) else {}
-        )
-        document_context = _build_document_context(state.get("documents_text", []))
+    def build_request(self, state: Dict[str, Any]) -> AgentRequest:
+        patient_info = _get_typed(state, "patient_info", dict, {})
+        route = _get_typed(state, "route", dict, {})
+        specialist_result = _get_typed(state, "specialist_result", dict, {})
+        document_context = _resolve_document_context(state)
 
         system_prompt, user_prompt = self._build_summary_prompts(
             patient_info=patient_info,
@@ -571,41 +967,55 @@ class SummaryAgent(BaseAgent):
             specialist_result=specialist_result,
             document_context=document_context,
         )
-        raw_result = self.llm.chat_json(system_prompt, user_prompt) or {}
-        final_result = self._normalize_final_result(raw_result, patient_info, document_context)
+        return AgentRequest(
+            system_prompt,
+            user_prompt,
+            {"patient_info": patient_info, "document_context": document_context},
+        )
 
+    def _prepared_update(self, raw_result: Dict[str, Any], context: Dict[str, Any]) -> Dict[str, Any]:
+        final_result = self._normalize_final_result(
+            raw_result, context["patient_info"], context["document_context"]
+        )
         return {
             "final_result": final_result,
             "next_action": "done",
         }
 
-    def stream_reply(self, state: Dict[str, Any]) -> Generator[str, None, None]:
-        patient_info = state.get("patient_info", {}) if isinstance(state.get("patient_info"), dict) else {}
-        route = state.get("route", {}) if isinstance(state.get("route"), dict) else {}
-        specialist_result = (
-            state.get("specialist_result", {}) if isinstance(state.get("specialist_result"), dict) else {}
-        )
-        final_result = state.get("final_result", {}) if isinstance(state.get("final_result"), dict) else {}
-        document_context = _build_document_context(state.get("documents_text", []))
-
-        summary_reply_builder = getattr(prompt_builders, "build_summary_reply_prompts", None)
+    def prepare(
+        self,
+        state: Dict[str, Any],
+        on_field: Optional[Callable[[Dict[str, Any]], None]] = None,
+    ) -> Dict[str, Any]:
+        """生成结构化总结；传入 on_field 时每个字段生成完即回调（如先渲染 diagnosis_summary）。"""
+        request = self.build_request(state)
+        raw_result = self._request_raw(request, on_field)
+        return self._prepared_update(raw_result or {}, request.context)
 
-        if callable(summary_reply_builder):
-            try:
-                system_prompt, user_prompt = summary_reply_builder(
-                    patient_info=patient_info,
-                    route=route,
-                    specialist_result=specialist_result,
-                    final_result=final_result,
-                    document_context=document_context,
-                )
-            except TypeError:
-                system_prompt, user_prompt = summary_reply_builder(
-                    patient_info,
-                    route,
-                    specialist_result,
-                    final_result,
-                )
+    def stream_reply(
+        self,
+        state: Dict[str, Any],
+        flush_chars: int = 64,
+        flush_interval: float = 0.05,
+    ) -> Generator[str, None, None]:
+        """流式输出最终回复；小片段按 flush_chars / flush_interval 合并后再输出（flush_chars<=0 关闭合并）。"""
+        yield from coalesce_chunks(self._stream_reply_raw(state), flush_chars, flush_interval)
+
+    def _stream_reply_raw(self, state: Dict[str, Any]) -> Generator[str, None, None]:
+        patient_info = _get_typed(state, "patient_info", dict, {})
+        route = _get_typed(state, "route", dict, {})
+        specialist_result = _get_typed(state, "specialist_result", dict, {})
+        final_result = _get_typed(state, "final_result", dict, {})
+        document_context = _resolve_document_context(state)
+
+        if _SUMMARY_REPLY_PROMPT_BUILDER is not None:
+            system_prompt, user_prompt = _SUMMARY_REPLY_PROMPT_BUILDER(
+                patient_info=patient_info,
+                route=route,
+                specialist_result=specialist_result,
+                final_result=final_result,
+                document_context=document_context,
+            )
         else:
             system_prompt, user_prompt = self._build_summary_reply_prompts_fallback(
                 patient_info=patient_info,
@@ -622,10 +1032,21 @@ class SummaryAgent(BaseAgent):
             max_tokens=1200,
         )
 
+    async def stream_reply_async(
+        self,
+        state: Dict[str, Any],
+        flush_chars: int = 64,
+        flush_interval: float = 0.05,
+    ) -> AsyncGenerator[str, None]:
+        """stream_reply 的异步版本：提示词构建与网络读取都在线程中进行，合并缓冲按时间兜底刷新。"""
+        raw_chunks = iterate_in_thread(self._stream_reply_raw(state))
+        async for chunk in coalesce_chunks_async(raw_chunks, flush_chars, flush_interval):
+            yield chunk
+
     def fallback_reply(self, state: Dict[str, Any]) -> str:
-        route = state.get("route", {}) if isinstance(state.get("route"), dict) else {}
+        route = _get_typed(state, "route", dict, {})
         department = _safe_text(route.get("department"), "全科")
-        final_result = state.get("final_result", {}) if isinstance(state.get("final_result"), dict) else {}
+        final_result = _get_typed(state, "final_result", dict, {})
 
         try:
             return render_final_reply(department, final_result)
@@ -653,14 +1074,105 @@ class SummaryAgent(BaseAgent):
             ]
             return "\n".join(lines).strip()
 
-    def run(self, state: Dict[str, Any]) -> Dict[str, Any]:
-        update = self.prepare(state)
+    def apply_result(
+        self,
+        state: Dict[str, Any],
+        raw_result: Dict[str, Any],
+        context: Dict[str, Any],
+    ) -> Dict[str, Any]:
+        update = self._prepared_update(raw_result, context)
 
         merged_state = dict(state)
         merged_state.update(update)
 
         assistant_reply = self.fallback_reply(merged_state)
-        history = list(state.get("history", [])) if isinstance(state.get("history"), list) else []
+        history = list(_get_typed(state, "history", list, []))
+        history.append({"role": "assistant", "content": assistant_reply})
+
+        update["assistant_reply"] = assistant_reply
+        update["history"] = history
+        return update
+
+
+class CombinedAgent(BaseAgent):
+    """
+    路由 + 专科 + 总结 合并为一次 LLM 调用，减少串行往返；
+    分诊把握不足（confidence < MIN_CONFIDENCE）或输出不完整时，
+    回退到逐个智能体的原始链路。
+    注意：目前只接入 app/workflow.py 的 LangGraph 工作流；main.py 的 SSE 接口仍按
+    router -> specialist -> summary 分阶段调用（以便逐阶段推送进度并流式输出回复），不经过这里。
+    """
+
+    MIN_CONFIDENCE = 0.6
+    MAX_TOKENS = 3000
+    RESULT_SCHEMA = CombinedResult
+    STREAM_FIELDS = True
+
+    def __init__(self, llm: LLMClient) -> None:
+        super().__init__(llm)
+        self.router = RouterAgent(llm)
+        self.specialist = SpecialistAgent(llm)
+        self.summary = SummaryAgent(llm)
+
+    def run_sequential(self, state: Dict[str, Any]) -> Dict[str, Any]:
+        merged_state = dict(state)
+        update: Dict[str, Any] = {}
+        for agent in (self.router, self.specialist, self.summary):
+            step = agent.run(merged_state)
+            merged_state.update(step)
+            update.update(step)
+        return update
+
+    def build_request(self, state: Dict[str, Any]) -> AgentRequest:
+        patient_info = _get_typed(state, "patient_info", dict, {})
+        document_context = _resolve_document_context(state)
+
+        system_prompt, user_prompt = prompt_builders.build_combined_prompts(
+            patient_info=_canonical_patient_info(patient_info),
+            document_context=document_context,
+        )
+        return AgentRequest(
+            system_prompt,
+            user_prompt,
+            {"patient_info": patient_info, "document_context": document_context},
+        )
+
+    def apply_result(
+        self,
+        state: Dict[str, Any],
+        raw_result: Dict[str, Any],
+        context: Dict[str, Any],
+    ) -> Dict[str, Any]:
+        patient_info = context["patient_info"]
+        document_context = context["document_context"]
+
+        raw_route = raw_result.get("route")
+        raw_specialist = raw_result.get("specialist_result")
+        raw_final = raw_result.get("final_result")
+        if not all(isinstance(part, dict) and part for part in (raw_route, raw_specialist, raw_final)):
+            return self.run_sequential(state)
+
+        route = self.router._normalize_route(raw_route, patient_info, document_context)
+        confidence = route.get("confidence")
+        if confidence is None or confidence < self.MIN_CONFIDENCE:
+            return self.run_sequential(state)
+
+        specialist_result = self.specialist._normalize_specialist_result(
+            raw_specialist, patient_info, document_context
+        )
+        final_result = self.summary._normalize_final_result(raw_final, patient_info, document_context)
+
+        update: Dict[str, Any] = {
+            "route": route,
+            "specialist_result": specialist_result,
+            "final_result": final_result,
+            "next_action": "done",
+        }
+        merged_state = dict(state)
+        merged_state.update(update)
+
+        assistant_reply = self.summary.fallback_reply(merged_state)
+        history = list(_get_typed(state, "history", list, []))
         history.append({"role": "assistant", "content": assistant_reply})
 
         update["assistant_reply"] = assistant_reply
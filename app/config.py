@@ -2,6 +2,7 @@ from __future__ import annotations
 
 import os
 from dataclasses import dataclass
+from functools import lru_cache
 
 from dotenv import load_dotenv
 
@@ -13,10 +14,16 @@ class AppConfig:
     openai_base_url: str | None
     model: str
     temperature: float
+    cache_max_entries: int = 256
+    cache_ttl_seconds: float = 0.0
+    cache_max_temperature: float = 0.2
+    semantic_cache_model: str = ""
+    semantic_cache_threshold: float = 0.95
 
     @classmethod
+    @lru_cache(maxsize=1)
     def from_env(cls) -> "AppConfig":
-        """从环境变量读取配置。"""
+        """从环境变量读取配置（结果缓存，.env 只加载一次；需要重新读取时调用 from_env.cache_clear()）。"""
         load_dotenv()
 
         api_key = os.getenv("OPENAI_API_KEY", "").strip()
@@ -32,9 +39,36 @@ class AppConfig:
         except ValueError:
             temperature = 0.2
 
+        try:
+            cache_max_entries = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "256").strip())
+        except ValueError:
+            cache_max_entries = 256
+
+        try:
+            cache_ttl_seconds = float(os.getenv("LLM_CACHE_TTL_SECONDS", "0").strip())
+        except ValueError:
+            cache_ttl_seconds = 0.0
+
+        try:
+            cache_max_temperature = float(os.getenv("LLM_CACHE_MAX_TEMPERATURE", "0.2").strip())
+        except ValueError:
+            cache_max_temperature = 0.2
+
+        # 语义缓存：填写本地向量模型名（如 BAAI/bge-small-zh-v1.5）即开启，留空关闭
+        semantic_cache_model = os.getenv("LLM_SEMANTIC_CACHE_MODEL", "").strip()
+        try:
+            semantic_cache_threshold = float(os.getenv("LLM_SEMANTIC_CACHE_THRESHOLD", "0.95").strip())
+        except ValueError:
+            semantic_cache_threshold = 0.95
+
         return cls(
             openai_api_key=api_key,
             openai_base_url=base_url,
             model=model,
             temperature=temperature,
+            cache_max_entries=cache_max_entries,
+            cache_ttl_seconds=cache_ttl_seconds,
+            cache_max_temperature=cache_max_temperature,
+            semantic_cache_model=semantic_cache_model,
+            semantic_cache_threshold=semantic_cache_threshold,
         )
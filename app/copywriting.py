@@ -14,6 +14,9 @@ FIELD_QUESTION_MAP: Dict[str, str] = {
     "current_meds": "目前正在使用哪些药物？没有可写“无”。",
 }
 
+# 启动时固定字段顺序，按缺失字段生成问题时按此顺序输出
+_FIELD_KEYS = tuple(FIELD_QUESTION_MAP)
+
 
 def normalize_missing_questions(
     missing_fields: Optional[List[str]],
@@ -25,6 +28,7 @@ def normalize_missing_questions(
     - 如果模型没给问题，则根据 missing_fields 自动生成
     """
     result: List[str] = []
+    seen = set()
 
     # 先处理模型给的 missing_questions
     for item in (missing_questions or []):
@@ -36,14 +40,13 @@ def normalize_missing_questions(
         if text in FIELD_QUESTION_MAP:
             text = FIELD_QUESTION_MAP[text]
 
-        if text not in result:
+        if text not in seen:
+            seen.add(text)
             result.append(text)
 
     # 如果还没有问题，则根据 missing_fields 生成
-    if not result:
-        for field in (missing_fields or []):
-            key = str(field).strip()
-            if key in FIELD_QUESTION_MAP and FIELD_QUESTION_MAP[key] not in result:
-                result.append(FIELD_QUESTION_MAP[key])
+    if not result and missing_fields:
+        requested = {str(field).strip() for field in missing_fields}
+        result = [FIELD_QUESTION_MAP[key] for key in _FIELD_KEYS if key in requested]
 
     return result
@@ -1,13 +1,82 @@
 from __future__ import annotations
 
+import asyncio
+import copy
+import hashlib
 import json
 import re
-from typing import Any, Dict, Generator
-
-from openai import OpenAI
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, AsyncGenerator, AsyncIterator, Dict, Generator, Iterable, Iterator, List, Optional, Tuple, TypeVar
+
+import httpx
+from openai import DefaultHttpxClient, OpenAI
+
+# 可选：orjson 解析更快（C 实现），未安装时退回标准库
+try:
+    import orjson
+except ImportError:
+    orjson = None  # type: ignore[assignment]
+
+# 可选：msgspec 可在 C 层一次完成 JSON 解析 + 结构校验
+try:
+    import msgspec
+except ImportError:
+    msgspec = None  # type: ignore[assignment]
+
+# 可选：语义缓存依赖本地向量模型，未安装时自动关闭
+try:
+    import numpy as np
+    from sentence_transformers import SentenceTransformer
+except ImportError:
+    np = None  # type: ignore[assignment]
+    SentenceTransformer = None  # type: ignore[assignment]
+
+# 可选：安装 h2 后共享连接池启用 HTTP/2 多路复用
+try:
+    import h2  # noqa: F401
+
+    _HTTP2_AVAILABLE = True
+except ImportError:
+    _HTTP2_AVAILABLE = False
 
 from app.config import AppConfig
 
+T = TypeVar("T")
+
+_json_loads = orjson.loads if orjson is not None else json.loads
+
+
+def _json_dumps_bytes(value: Any, sort_keys: bool = False) -> bytes:
+    """序列化为 UTF-8 JSON bytes：优先 orjson，失败（如非 str 键）或未安装时退回标准库。"""
+    if orjson is not None:
+        try:
+            return orjson.dumps(value, option=orjson.OPT_SORT_KEYS if sort_keys else 0)
+        except TypeError:
+            pass
+    return json.dumps(value, ensure_ascii=False, sort_keys=sort_keys).encode("utf-8")
+
+_SHARED_HTTP_CLIENT: Optional[httpx.Client] = None
+_SHARED_HTTP_CLIENT_LOCK = threading.Lock()
+
+
+def shared_http_client() -> httpx.Client:
+    """
+    进程内共享的 httpx 连接池：所有 LLMClient（以及复用其 client 的 OCR）共用 keep-alive 连接，
+    各阶段串行调用不再重复 TCP/TLS 握手；安装 h2 时启用 HTTP/2。
+    """
+    global _SHARED_HTTP_CLIENT
+    if _SHARED_HTTP_CLIENT is None:
+        with _SHARED_HTTP_CLIENT_LOCK:
+            if _SHARED_HTTP_CLIENT is None:
+                _SHARED_HTTP_CLIENT = DefaultHttpxClient(
+                    http2=_HTTP2_AVAILABLE,
+                    limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+                    timeout=httpx.Timeout(60.0, connect=5.0),
+                )
+    return _SHARED_HTTP_CLIENT
+
 
 def _pick_config_value(config: AppConfig, *names: str, default: Any = None) -> Any:
     for name in names:
@@ -25,12 +94,391 @@ def _to_float(value: Any, default: float) -> float:
         return default
 
 
+async def iterate_in_thread(iterator: Iterator[T]) -> AsyncGenerator[T, None]:
+    """在单个工作线程中驱动同步迭代器，经 asyncio.Queue 交回事件循环（用于流式输出）。
+
+    消费方提前退出（break / 取消 / aclose）时通知工作线程停止，并由工作线程关闭迭代器，
+    使底层流式响应及时释放。
+    """
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue[Tuple[bool, Any]] = asyncio.Queue()
+    stop = threading.Event()
+
+    def _put(done: bool, payload: Any) -> None:
+        try:
+            loop.call_soon_threadsafe(queue.put_nowait, (done, payload))
+        except RuntimeError:
+            # 事件循环已关闭，消费方不再需要数据
+            stop.set()
+
+    def _produce() -> None:
+        error: Optional[BaseException] = None
+        try:
+            for item in iterator:
+                if stop.is_set():
+                    break
+                _put(False, item)
+        except BaseException as exc:  # noqa: BLE001 - 原样转交给消费方
+            error = exc
+        finally:
+            # 生成器只能在推进它的线程里关闭，因此由工作线程负责
+            close = getattr(iterator, "close", None)
+            if callable(close):
+                try:
+                    close()
+                except Exception:
+                    pass
+        _put(True, error)
+
+    threading.Thread(target=_produce, name="iterate-in-thread", daemon=True).start()
+
+    try:
+        while True:
+            done, payload = await queue.get()
+            if done:
+                if payload is not None:
+                    raise payload
+                return
+            yield payload
+    finally:
+        stop.set()
+
+
+def coalesce_chunks(
+    chunks: Iterable[str],
+    min_chars: int = 64,
+    max_delay: float = 0.05,
+) -> Generator[str, None, None]:
+    """
+    合并流式小片段：攒够 min_chars 个字符或距首个片段超过 max_delay 秒再输出，
+    减少下游逐 token 的 yield / SSE 封包开销。min_chars <= 0 时原样透传。
+    同步版本只能在新片段到达时检查时间。
+    """
+    if min_chars <= 0:
+        yield from chunks
+        return
+
+    buffer: List[str] = []
+    size = 0
+    started = 0.0
+    for chunk in chunks:
+        if not chunk:
+            continue
+        if not buffer:
+            started = time.monotonic()
+        buffer.append(chunk)
+        size += len(chunk)
+        if size >= min_chars or time.monotonic() - started >= max_delay:
+            yield "".join(buffer)
+            buffer.clear()
+            size = 0
+    if buffer:
+        yield "".join(buffer)
+
+
+async def coalesce_chunks_async(
+    chunks: AsyncIterator[str],
+    min_chars: int = 64,
+    max_delay: float = 0.05,
+) -> AsyncGenerator[str, None]:
+    """coalesce_chunks 的异步版本：用计时等待保证缓冲最多停留 max_delay 秒。"""
+    if min_chars <= 0:
+        async for chunk in chunks:
+            yield chunk
+        return
+
+    iterator = chunks.__aiter__()
+    buffer: List[str] = []
+    size = 0
+    deadline = 0.0
+    pending: Optional[asyncio.Future] = None
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(iterator.__anext__())
+            timeout = max(0.0, deadline - loop.time()) if buffer else None
+            done, _ = await asyncio.wait({pending}, timeout=timeout)
+            if not done:
+                # 超时：先把已缓冲的内容发出去，下一片段继续等待
+                yield "".join(buffer)
+                buffer.clear()
+                size = 0
+                continue
+
+            try:
+                chunk = pending.result()
+            except StopAsyncIteration:
+                pending = None
+                break
+            pending = None
+            if not chunk:
+                continue
+            if not buffer:
+                deadline = loop.time() + max_delay
+            buffer.append(chunk)
+            size += len(chunk)
+            if size >= min_chars:
+                yield "".join(buffer)
+                buffer.clear()
+                size = 0
+    finally:
+        if pending is not None:
+            pending.cancel()
+
+    if buffer:
+        yield "".join(buffer)
+
+
+_FENCE_RE = re.compile(r"```(?:json)?\s*([\s\S]*?)```", re.IGNORECASE)
+_JSON_DECODER = json.JSONDecoder()
+_JSON_WHITESPACE = " \t\n\r"
+
+
+class _TopLevelJsonScanner:
+    """
+    增量扫描流式 JSON 对象的顶层键值：每喂入一段文本，返回本次新完成的 (key, value)。
+    字符串/对象/数组以闭合符号为准；数字需要看到其后的字符才算完成（避免 "12" 被截成 "1"）。
+    对象开头之前的内容（如 ```json 代码块标记）会被跳过。
+    """
+
+    def __init__(self) -> None:
+        self.buffer = ""
+        self.pos = -1  # -1 表示还没遇到顶层 "{"
+        self.done = False
+
+    def _skip(self, chars: str) -> None:
+        while self.pos < len(self.buffer) and self.buffer[self.pos] in chars:
+            self.pos += 1
+
+    def feed(self, text: str) -> List[Tuple[str, Any]]:
+        self.buffer += text
+        items: List[Tuple[str, Any]] = []
+        if self.done:
+            return items
+
+        if self.pos < 0:
+            start = self.buffer.find("{")
+            if start < 0:
+                return items
+            self.pos = start + 1
+
+        while True:
+            self._skip(_JSON_WHITESPACE + ",")
+            if self.pos >= len(self.buffer):
+                return items
+            if self.buffer[self.pos] == "}":
+                self.done = True
+                return items
+
+            try:
+                key, value_start = _JSON_DECODER.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                return items
+            while value_start < len(self.buffer) and self.buffer[value_start] in _JSON_WHITESPACE:
+                value_start += 1
+            if value_start >= len(self.buffer):
+                return items
+            if self.buffer[value_start] != ":":
+                self.done = True  # 结构异常，交给整体解析兜底
+                return items
+            value_start += 1
+            while value_start < len(self.buffer) and self.buffer[value_start] in _JSON_WHITESPACE:
+                value_start += 1
+
+            try:
+                value, end = _JSON_DECODER.raw_decode(self.buffer, value_start)
+            except ValueError:
+                return items
+            if isinstance(value, (int, float)) and not isinstance(value, bool) and end >= len(self.buffer):
+                return items
+
+            self.pos = end
+            if isinstance(key, str):
+                items.append((key, value))
+
+
+class PromptCache:
+    """
+    LLM 响应精确匹配缓存（chat_text 存文本，chat_json 存解析后的 dict）：
+    - 键 = sha256(model, temperature, max_tokens, system_prompt, 合并空白后的 user_prompt)
+    - 只缓存 temperature <= max_temperature 的近似确定性调用
+    - LRU 淘汰 + 可选 TTL，线程安全（各阶段在线程池中并发调用）
+    - stats 记录命中/未命中次数
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 256,
+        ttl_seconds: float = 0.0,
+        max_temperature: float = 0.2,
+    ) -> None:
+        self.max_entries = max(0, int(max_entries))
+        self.ttl_seconds = max(0.0, float(ttl_seconds))
+        self.max_temperature = float(max_temperature)
+        self._data: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        # 只合并连续空白，不删除空白、不改大小写："120 80" 与 "1208 0"、"mmol/L" 与 "mmol/l" 必须是不同的键
+        return " ".join(str(text or "").split())
+
+    def cacheable(self, temperature: float) -> bool:
+        return self.max_entries > 0 and temperature <= self.max_temperature
+
+    def make_key(
+        self,
+        system_prompt: str,
+        user_prompt: str,
+        *,
+        model: str = "",
+        temperature: float = 0.0,
+        max_tokens: int = 0,
+        kind: str = "json",
+    ) -> str:
+        raw = _json_dumps_bytes(
+            {
+                "k": kind,
+                "m": model,
+                "t": temperature,
+                "mt": max_tokens,
+                "s": str(system_prompt or ""),
+                "u": self.normalize(user_prompt),
+            },
+            sort_keys=True,
+        )
+        return hashlib.sha256(raw).hexdigest()
+
+    def get(self, key: str) -> Any:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] and entry[0] < time.monotonic():
+                del self._data[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._data.move_to_end(key)
+        return copy.deepcopy(entry[1])
+
+    def set(self, key: str, payload: Any) -> None:
+        if self.max_entries <= 0 or not payload:
+            return
+        expires_at = time.monotonic() + self.ttl_seconds if self.ttl_seconds else 0.0
+        with self._lock:
+            self._data[key] = (expires_at, copy.deepcopy(payload))
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                "size": len(self._data),
+            }
+
+
+class SemanticCache:
+    """
+    chat_json 语义缓存（精确缓存未命中后再查）：
+    - 用本地 sentence-transformers 模型把 user_prompt 编码为归一化向量
+    - 同一命名空间（model + system_prompt + max_tokens）内做一次矩阵乘，余弦相似度 >= threshold 即命中
+    - 每个命名空间最多 max_entries 条，先进先出；可选 TTL
+    模型在首次使用时才加载，依赖缺失或加载失败则整体关闭。
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        threshold: float = 0.95,
+        max_entries: int = 256,
+        ttl_seconds: float = 0.0,
+    ) -> None:
+        self.model_name = model_name
+        self.threshold = float(threshold)
+        self.max_entries = max(0, int(max_entries))
+        self.ttl_seconds = max(0.0, float(ttl_seconds))
+        self.enabled = bool(model_name) and SentenceTransformer is not None and self.max_entries > 0
+        self._encoder: Any = None
+        # 命名空间 -> (向量矩阵 (N, dim) float32, [(过期时间, payload)])
+        self._spaces: Dict[str, Tuple[Any, List[Tuple[float, Dict[str, Any]]]]] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_namespace(system_prompt: str, model: str, max_tokens: int) -> str:
+        raw = f"{model}\x00{max_tokens}\x00{system_prompt or ''}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _encode(self, text: str) -> Any:
+        if self._encoder is None:
+            with self._lock:
+                if self._encoder is None:
+                    try:
+                        self._encoder = SentenceTransformer(self.model_name, device="cpu")
+                    except Exception:
+                        self.enabled = False
+                        return None
+        vector = self._encoder.encode(str(text or ""), normalize_embeddings=True)
+        return np.asarray(vector, dtype=np.float32)
+
+    def lookup(self, namespace: str, user_prompt: str) -> Tuple[Optional[Dict[str, Any]], Any]:
+        """返回 (命中的 payload 或 None, 查询向量)；查询向量留给 store 复用，避免重复编码。"""
+        if not self.enabled:
+            return None, None
+        query = self._encode(user_prompt)
+        if query is None:
+            return None, None
+
+        with self._lock:
+            space = self._spaces.get(namespace)
+            if space is None:
+                return None, query
+            matrix, entries = space
+            scores = matrix @ query
+            best = int(np.argmax(scores))
+            expires_at, payload = entries[best]
+            if scores[best] < self.threshold or (expires_at and expires_at < time.monotonic()):
+                return None, query
+        return copy.deepcopy(payload), query
+
+    def store(self, namespace: str, query: Any, payload: Dict[str, Any]) -> None:
+        if not self.enabled or query is None or not payload:
+            return
+        expires_at = time.monotonic() + self.ttl_seconds if self.ttl_seconds else 0.0
+        with self._lock:
+            space = self._spaces.get(namespace)
+            if space is None:
+                matrix, entries = query.reshape(1, -1), []
+            else:
+                matrix, entries = space
+                matrix = np.vstack((matrix, query))
+            entries = entries + [(expires_at, copy.deepcopy(payload))]
+            if len(entries) > self.max_entries:
+                matrix = matrix[-self.max_entries :]
+                entries = entries[-self.max_entries :]
+            self._spaces[namespace] = (matrix, entries)
+
+
 class LLMClient:
     def __init__(self, config: AppConfig) -> None:
         api_key = _pick_config_value(config, "openai_api_key", "api_key", default="")
         base_url = _pick_config_value(config, "openai_base_url", "base_url", default="")
         model = _pick_config_value(config, "model", default="gpt-4o-mini")
         temperature = _pick_config_value(config, "temperature", default=0.2)
+        cache_max_entries = _pick_config_value(config, "cache_max_entries", default=256)
+        cache_ttl_seconds = _pick_config_value(config, "cache_ttl_seconds", default=0.0)
+        cache_max_temperature = _pick_config_value(config, "cache_max_temperature", default=0.2)
+        semantic_cache_model = _pick_config_value(config, "semantic_cache_model", default="")
+        semantic_cache_threshold = _pick_config_value(config, "semantic_cache_threshold", default=0.95)
 
         api_key = str(api_key or "").strip()
         base_url = str(base_url or "").strip()
@@ -39,33 +487,50 @@ class LLMClient:
         if base_url:
             client_kwargs["base_url"] = base_url
 
-        self.client = OpenAI(**client_kwargs)
+        self.client = OpenAI(http_client=shared_http_client(), **client_kwargs)
         self.model = str(model or "gpt-4o-mini")
         self.temperature = _to_float(temperature, 0.2)
+        self.cache = PromptCache(
+            max_entries=int(_to_float(cache_max_entries, 256)),
+            ttl_seconds=_to_float(cache_ttl_seconds, 0.0),
+            max_temperature=_to_float(cache_max_temperature, 0.2),
+        )
+        self.semantic_cache = SemanticCache(
+            model_name=str(semantic_cache_model or "").strip(),
+            threshold=_to_float(semantic_cache_threshold, 0.95),
+            max_entries=int(_to_float(cache_max_entries, 256)),
+            ttl_seconds=_to_float(cache_ttl_seconds, 0.0),
+        )
+
+    def _effective_temperature(self, temperature: float | None) -> float:
+        return self.temperature if temperature is None else float(temperature)
 
     @staticmethod
-    def _extract_text(content: Any) -> str:
+    def _part_text(part: Any) -> Any:
+        """取内容片段中的文本：dict 直接 get（最常见），否则按 SDK 对象属性读取。"""
+        try:
+            return part.get("text") or part.get("output_text")
+        except AttributeError:
+            text = getattr(part, "text", None)
+            return getattr(part, "output_text", None) if text is None else text
+
+    @classmethod
+    def _extract_text(cls, content: Any) -> str:
+        # SDK 返回的内容几乎总是 str，用 type() 精确判断走最短路径
+        content_type = type(content)
+        if content_type is str:
+            return content.strip()
         if content is None:
             return ""
 
-        if isinstance(content, str):
-            return content.strip()
-
-        if isinstance(content, list):
+        if content_type is list:
             parts = []
             for item in content:
-                text: Any = None
-
-                if isinstance(item, dict):
-                    text = item.get("text") or item.get("output_text")
-                else:
-                    text = getattr(item, "text", None)
-                    if text is None:
-                        text = getattr(item, "output_text", None)
-
-                if isinstance(text, str) and text.strip():
-                    parts.append(text.strip())
-
+                text = cls._part_text(item)
+                if type(text) is str:
+                    text = text.strip()
+                    if text:
+                        parts.append(text)
             return "\n".join(parts).strip()
 
         return str(content).strip()
@@ -76,9 +541,11 @@ class LLMClient:
         if not raw:
             return ""
 
-        fenced_blocks = re.findall(r"```(?:json)?\s*([\s\S]*?)```", raw, flags=re.IGNORECASE)
-        if fenced_blocks:
-            raw = fenced_blocks[0].strip()
+        # 绝大多数响应没有代码块，先用子串判断跳过正则；有代码块时只取第一个
+        if "```" in raw:
+            fenced = _FENCE_RE.search(raw)
+            if fenced:
+                raw = fenced.group(1).strip()
 
         left = raw.find("{")
         right = raw.rfind("}")
@@ -87,18 +554,17 @@ class LLMClient:
 
         return raw.strip()
 
-    def chat_text(
+    def _complete_text(
         self,
         system_prompt: str,
         user_prompt: str,
-        *,
-        model: str | None = None,
-        temperature: float | None = None,
-        max_tokens: int = 1200,
+        model: str,
+        temperature: float,
+        max_tokens: int,
     ) -> str:
         response = self.client.chat.completions.create(
-            model=model or self.model,
-            temperature=self.temperature if temperature is None else float(temperature),
+            model=model,
+            temperature=temperature,
             max_tokens=max_tokens,
             messages=[
                 {"role": "system", "content": system_prompt},
@@ -107,6 +573,36 @@ class LLMClient:
         )
         return self._extract_text(response.choices[0].message.content)
 
+    def chat_text(
+        self,
+        system_prompt: str,
+        user_prompt: str,
+        *,
+        model: str | None = None,
+        temperature: float | None = None,
+        max_tokens: int = 1200,
+    ) -> str:
+        model_name = model or self.model
+        effective_temp = self._effective_temperature(temperature)
+        if not self.cache.cacheable(effective_temp):
+            return self._complete_text(system_prompt, user_prompt, model_name, effective_temp, max_tokens)
+
+        cache_key = self.cache.make_key(
+            system_prompt,
+            user_prompt,
+            model=model_name,
+            temperature=effective_temp,
+            max_tokens=max_tokens,
+            kind="text",
+        )
+        cached = self.cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+        text = self._complete_text(system_prompt, user_prompt, model_name, effective_temp, max_tokens)
+        self.cache.set(cache_key, text)
+        return text
+
     def chat_json(
         self,
         system_prompt: str,
@@ -115,32 +611,244 @@ class LLMClient:
         model: str | None = None,
         temperature: float | None = None,
         max_tokens: int = 1600,
+        schema: Any = None,
+        semantic_cache: bool = False,
     ) -> Dict[str, Any]:
-        text = self.chat_text(
-            system_prompt=system_prompt,
-            user_prompt=user_prompt,
-            model=model,
-            temperature=temperature,
-            max_tokens=max_tokens,
+        """semantic_cache=True 时，精确缓存未命中后再按语义相似度查找（仅用于可容忍近似命中的分诊调用）。"""
+        model_name = model or self.model
+        effective_temp = self._effective_temperature(temperature)
+        use_cache = self.cache.cacheable(effective_temp)
+
+        cache_key = ""
+        if use_cache:
+            cache_key = self.cache.make_key(
+                system_prompt,
+                user_prompt,
+                model=model_name,
+                temperature=effective_temp,
+                max_tokens=max_tokens,
+            )
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                return cached
+
+        namespace, query = "", None
+        if use_cache and semantic_cache and self.semantic_cache.enabled:
+            namespace = self.semantic_cache.make_namespace(system_prompt, model_name, max_tokens)
+            cached, query = self.semantic_cache.lookup(namespace, user_prompt)
+            if cached is not None:
+                self.cache.set(cache_key, cached)
+                return cached
+
+        # 直接取原始文本，避免 chat_text 再缓存一份同内容的字符串
+        text = self._complete_text(system_prompt, user_prompt, model_name, effective_temp, max_tokens)
+
+        payload = self._parse_json_text(text, schema)
+        if use_cache:
+            self.cache.set(cache_key, payload)
+            if query is not None:
+                self.semantic_cache.store(namespace, query, payload)
+        return payload
+
+    def chat_json_batch(
+        self,
+        prompts: List[Tuple[str, str]],
+        *,
+        model: str | None = None,
+        temperature: float | None = None,
+        max_tokens: int = 1600,
+        poll_interval: float = 10.0,
+        timeout: float | None = None,
+        output_jsonl: str | None = None,
+        schema: Any = None,
+    ) -> List[Dict[str, Any]]:
+        """
+        通过 Batch API 批量执行 chat_json（离线评测 / 批量回放用，成本约为实时调用的一半）：
+        1) 已命中缓存的请求直接返回，其余写成 JSONL 上传
+        2) 创建批处理任务并轮询直到结束
+        3) 按 custom_id 取回结果并解析为 dict（顺序与 prompts 一致）
+        """
+        model_name = model or self.model
+        effective_temp = self._effective_temperature(temperature)
+        use_cache = self.cache.cacheable(effective_temp)
+
+        results: List[Dict[str, Any]] = [{} for _ in prompts]
+        cache_keys = [
+            self.cache.make_key(
+                system_prompt,
+                user_prompt,
+                model=model_name,
+                temperature=effective_temp,
+                max_tokens=max_tokens,
+            )
+            if use_cache
+            else ""
+            for system_prompt, user_prompt in prompts
+        ]
+
+        lines: List[bytes] = []
+        for index, (system_prompt, user_prompt) in enumerate(prompts):
+            cached = self.cache.get(cache_keys[index]) if use_cache else None
+            if cached is not None:
+                results[index] = cached
+                continue
+            body = {
+                "model": model_name,
+                "temperature": effective_temp,
+                "max_tokens": max_tokens,
+                "messages": [
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": user_prompt},
+                ],
+            }
+            lines.append(
+                _json_dumps_bytes(
+                    {"custom_id": str(index), "method": "POST", "url": "/v1/chat/completions", "body": body}
+                )
+            )
+
+        if not lines:
+            return results
+
+        input_file = self.client.files.create(
+            file=("chat_json_batch.jsonl", b"\n".join(lines)),
+            purpose="batch",
+        )
+        batch = self.client.batches.create(
+            input_file_id=input_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
         )
 
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while batch.status not in {"completed", "failed", "expired", "cancelled"}:
+            if deadline is not None and time.monotonic() > deadline:
+                raise TimeoutError(f"批处理任务超时：{batch.id}")
+            time.sleep(poll_interval)
+            batch = self.client.batches.retrieve(batch.id)
+
+        if batch.status != "completed" or not batch.output_file_id:
+            raise RuntimeError(f"批处理任务失败：{batch.id}（{batch.status}）")
+
+        output_text = self.client.files.content(batch.output_file_id).text
+        if output_jsonl:
+            with open(output_jsonl, "w", encoding="utf-8") as fh:
+                fh.write(output_text)
+
+        for line in output_text.splitlines():
+            if not line.strip():
+                continue
+            try:
+                record = _json_loads(line)
+                index = int(record["custom_id"])
+                choices = record["response"]["body"]["choices"]
+                text = self._extract_text(choices[0]["message"]["content"])
+            except Exception:
+                continue
+            payload = self._parse_json_text(text, schema)
+            if use_cache:
+                self.cache.set(cache_keys[index], payload)
+            results[index] = payload
+
+        return results
+
+    def chat_json_stream(
+        self,
+        system_prompt: str,
+        user_prompt: str,
+        *,
+        model: str | None = None,
+        temperature: float | None = None,
+        max_tokens: int = 1600,
+        schema: Any = None,
+    ) -> Generator[Tuple[str, Any], None, None]:
+        """
+        流式版 chat_json：每当顶层字段生成完毕就产出 (key, value)，下游可以边生成边渲染。
+        流结束后再整体解析一次，补齐增量扫描没拿到的字段（代码块包裹、格式瑕疵等），并写入缓存。
+        """
+        model_name = model or self.model
+        effective_temp = self._effective_temperature(temperature)
+        use_cache = self.cache.cacheable(effective_temp)
+
+        cache_key = ""
+        if use_cache:
+            cache_key = self.cache.make_key(
+                system_prompt,
+                user_prompt,
+                model=model_name,
+                temperature=effective_temp,
+                max_tokens=max_tokens,
+            )
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                yield from cached.items()
+                return
+
+        scanner = _TopLevelJsonScanner()
+        emitted: set = set()
+        for chunk in self.chat_stream(
+            system_prompt,
+            user_prompt,
+            model=model_name,
+            temperature=effective_temp,
+            max_tokens=max_tokens,
+        ):
+            for key, value in scanner.feed(chunk):
+                if key not in emitted:
+                    emitted.add(key)
+                    yield key, value
+
+        payload = self._parse_json_text(scanner.buffer, schema)
+        for key, value in payload.items():
+            if key not in emitted:
+                yield key, value
+        if use_cache:
+            self.cache.set(cache_key, payload)
+
+    async def chat_json_async(
+        self,
+        system_prompt: str,
+        user_prompt: str,
+        **kwargs: Any,
+    ) -> Dict[str, Any]:
+        return await asyncio.to_thread(self.chat_json, system_prompt, user_prompt, **kwargs)
+
+    @classmethod
+    def _parse_json_text(cls, text: str, schema: Any = None) -> Dict[str, Any]:
+        """
+        解析模型输出的 JSON：
+        - 提供 schema（TypedDict）且安装了 msgspec 时，先走解析 + 校验一步完成的快速路径
+        - 快速路径失败（有代码块包裹、类型不符等）再走宽松解析
+        """
+        text = (text or "").strip()
         if not text:
             return {}
 
-        try:
-            payload = json.loads(text)
-            return payload if isinstance(payload, dict) else {}
-        except Exception:
-            pass
-
-        cleaned = self._cleanup_json_text(text)
-        if not cleaned:
+        # 常见情况：输出就是一个完整对象，直接解析，不进入清洗分支
+        looks_like_object = text[0] == "{" and text[-1] == "}"
+        if looks_like_object:
+            if schema is not None and msgspec is not None:
+                try:
+                    payload = msgspec.json.decode(text, type=schema)
+                    return payload if isinstance(payload, dict) else {}
+                except (msgspec.DecodeError, msgspec.ValidationError):
+                    pass
+
+            try:
+                payload = _json_loads(text)
+                return payload if isinstance(payload, dict) else {}
+            except ValueError:
+                pass
+
+        cleaned = cls._cleanup_json_text(text)
+        # 清洗没有改变内容时，再解析一次也只会同样失败
+        if not cleaned or (looks_like_object and cleaned == text):
             return {}
 
         try:
-            payload = json.loads(cleaned)
+            payload = _json_loads(cleaned)
             return payload if isinstance(payload, dict) else {}
-        except Exception:
+        except ValueError:
             return {}
 
     def chat_stream(
@@ -163,37 +871,47 @@ class LLMClient:
             ],
         )
 
-        for chunk in stream:
-            choices = getattr(chunk, "choices", None) or []
-            if not choices:
-                continue
-
-            delta = getattr(choices[0], "delta", None)
-            if delta is None:
-                continue
-
-            content = getattr(delta, "content", None)
-
-            if isinstance(content, str):
-                if content:
-                    yield content
-                continue
-
-            if isinstance(content, dict):
-                text = content.get("text") or content.get("output_text")
-                if isinstance(text, str) and text:
-                    yield text
-                continue
-
-            if isinstance(content, list):
-                for part in content:
-                    text: Any = None
-                    if isinstance(part, dict):
-                        text = part.get("text") or part.get("output_text")
-                    else:
-                        text = getattr(part, "text", None)
-                        if text is None:
-                            text = getattr(part, "output_text", None)
-
-                    if isinstance(text, str) and text:
+        try:
+            for chunk in stream:
+                choices = getattr(chunk, "choices", None) or []
+                if not choices:
+                    continue
+
+                delta = getattr(choices[0], "delta", None)
+                if delta is None:
+                    continue
+
+                content = getattr(delta, "content", None)
+
+                # 逐 token 的热路径：绝大多数 delta 是 str
+                content_type = type(content)
+                if content_type is str:
+                    if content:
+                        yield content
+                    continue
+
+                if content_type is dict:
+                    text = content.get("text") or content.get("output_text")
+                    if type(text) is str and text:
                         yield text
+                    continue
+
+                if content_type is list:
+                    for part in content:
+                        text = self._part_text(part)
+                        if type(text) is str and text:
+                            yield text
+        finally:
+            # 消费方提前退出时关闭 HTTP 响应，释放连接
+            close = getattr(stream, "close", None)
+            if callable(close):
+                close()
+
+    async def chat_stream_async(
+        self,
+        system_prompt: str,
+        user_prompt: str,
+        **kwargs: Any,
+    ) -> AsyncGenerator[str, None]:
+        async for chunk in iterate_in_thread(self.chat_stream(system_prompt, user_prompt, **kwargs)):
+            yield chunk
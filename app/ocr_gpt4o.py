@@ -1,9 +1,17 @@
 from __future__ import annotations
 
+import asyncio
 import base64
+import codecs
+import hashlib
 import io
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import List
+from typing import Any, BinaryIO, List, Tuple, Union
 
 from openai import OpenAI
 
@@ -19,6 +27,12 @@ try:
 except Exception:
     fitz = None  # type: ignore[assignment]
 
+# 可选：磁盘缓存（需显式设置 OCR_CACHE_DIR 才启用），重复上传同一文件时跳过解析 / OCR
+try:
+    import diskcache
+except Exception:
+    diskcache = None  # type: ignore[assignment]
+
 
 IMAGE_MIME_MAP = {
     ".png": "image/png",
@@ -31,11 +45,82 @@ IMAGE_MIME_MAP = {
 }
 TEXT_SUFFIX = {".txt", ".md", ".csv", ".json", ".xml"}
 
+# 每种 MIME 的 data URL 前缀（bytes），导入时构建一次
+_DATA_URL_PREFIX = {mime: f"data:{mime};base64,".encode("ascii") for mime in set(IMAGE_MIME_MAP.values())}
+
+# 扫描版 PDF 逐页 OCR 的最大并发数（同时也是对接口限速的简单保护）
+OCR_MAX_WORKERS = 4
+
+# 扫描页渲染参数：默认 150dpi JPEG；页面过于稀疏时提高到 220dpi 重试
+PAGE_IMAGE_MIME = "image/jpeg"
+PAGE_JPEG_QUALITY = 85
+OCR_BASE_DPI = 150
+OCR_RETRY_DPI = 220
+MIN_PAGE_IMAGE_BYTES = 20_000
+MIN_PAGE_OCR_CHARS = 40
+# 缩放矩阵只构建一次，各页复用
+_BASE_MATRIX = fitz.Matrix(OCR_BASE_DPI / 72, OCR_BASE_DPI / 72) if fitz is not None else None
+_RETRY_MATRIX = fitz.Matrix(OCR_RETRY_DPI / 72, OCR_RETRY_DPI / 72) if fitz is not None else None
+
+# 内容寻址缓存：键为文件 / 图片字节的 sha256，只缓存提取出的文本，不缓存渲染后的页面图片。
+# 缓存内容是病历原文，磁盘缓存默认关闭（设置 OCR_CACHE_DIR 才落盘），所有条目都有过期时间
+OCR_CACHE_DIR = os.getenv("OCR_CACHE_DIR", "").strip()
+OCR_CACHE_TTL_SECONDS = float(os.getenv("OCR_CACHE_TTL_SECONDS", "3600"))
+_MEMORY_CACHE_MAX_ENTRIES = 128
+
+
+class _MemoryCache:
+    """进程内 LRU + TTL 兜底，接口与 diskcache.Cache 的 get/set(expire=) 一致。"""
+
+    def __init__(self, max_entries: int) -> None:
+        self.max_entries = max_entries
+        self._data: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            if entry[0] and entry[0] < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return entry[1]
+
+    def set(self, key: str, value: Any, expire: float | None = None) -> None:
+        deadline = time.monotonic() + expire if expire else 0.0
+        with self._lock:
+            self._data[key] = (deadline, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+
+def _open_cache() -> Any:
+    if diskcache is not None and OCR_CACHE_DIR:
+        try:
+            return diskcache.Cache(OCR_CACHE_DIR)
+        except Exception:
+            pass
+    return _MemoryCache(_MEMORY_CACHE_MAX_ENTRIES)
+
+
+_CACHE = _open_cache()
+
+
+def _cache_set(key: str, text: str) -> None:
+    _CACHE.set(key, text, expire=OCR_CACHE_TTL_SECONDS if OCR_CACHE_TTL_SECONDS > 0 else None)
+
+
+def _sha256(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
 
 def _to_data_url(image_bytes: bytes, mime: str) -> str:
-    """把图片二进制转换为 data URL。"""
-    b64 = base64.b64encode(image_bytes).decode("utf-8")
-    return f"data:{mime};base64,{b64}"
+    """把图片二进制转换为 data URL：在 bytes 上拼接前缀，只做一次 ASCII 解码。"""
+    prefix = _DATA_URL_PREFIX.get(mime) or f"data:{mime};base64,".encode("ascii")
+    return (prefix + base64.b64encode(image_bytes)).decode("ascii")
 
 
 def _read_chat_content(content) -> str:
@@ -63,7 +148,12 @@ def _ocr_image_with_gpt4o(
     mime: str,
     model: str = "gpt-4o-mini",
 ) -> str:
-    """使用 GPT-4o 识别单张图片文本。"""
+    """使用 GPT-4o 识别单张图片文本（按图片内容 + 模型缓存结果）。"""
+    cache_key = f"{_sha256(image_bytes)}:ocr:{model}"
+    cached = _CACHE.get(cache_key)
+    if cached is not None:
+        return cached
+
     data_url = _to_data_url(image_bytes, mime)
 
     system_prompt = (
@@ -92,14 +182,22 @@ def _ocr_image_with_gpt4o(
         ],
     )
 
-    return _read_chat_content(resp.choices[0].message.content)
+    text = _read_chat_content(resp.choices[0].message.content)
+    if text:
+        _cache_set(cache_key, text)
+    return text
 
 
-def _extract_pdf_text_direct(pdf_bytes: bytes) -> str:
+def _extract_pdf_text_direct(pdf_bytes: bytes, digest: str | None = None) -> str:
     """优先尝试直接提取文本型 PDF。"""
     if PdfReader is None:
         return ""
 
+    cache_key = f"{digest or _sha256(pdf_bytes)}:text"
+    cached = _CACHE.get(cache_key)
+    if cached is not None:
+        return cached
+
     try:
         reader = PdfReader(io.BytesIO(pdf_bytes))
         parts: List[str] = []
@@ -107,24 +205,47 @@ def _extract_pdf_text_direct(pdf_bytes: bytes) -> str:
             text = (page.extract_text() or "").strip()
             if text:
                 parts.append(text)
-        return "\n".join(parts).strip()
+        text = "\n".join(parts).strip()
     except Exception:
         return ""
 
+    _cache_set(cache_key, text)
+    return text
 
-def _pdf_to_png_pages(pdf_bytes: bytes, max_pages: int = 8) -> List[bytes]:
-    """扫描版 PDF 转 PNG（每页一张），供 GPT-4o OCR。"""
+
+def _render_pages(doc: Any, indexes: List[int], matrix: Any) -> List[bytes]:
+    """按给定缩放矩阵把指定页渲染成 JPEG。"""
+    images: List[bytes] = []
+    for i in indexes:
+        pix = doc[i].get_pixmap(matrix=matrix, alpha=False)
+        images.append(pix.tobytes("jpeg", jpg_quality=PAGE_JPEG_QUALITY))
+    return images
+
+
+def _pdf_to_page_images(
+    pdf_bytes: bytes,
+    max_pages: int = 8,
+    high_res_pages: tuple = (),
+) -> List[bytes]:
+    """
+    扫描版 PDF 转 JPEG（每页一张），供 GPT-4o OCR：
+    - 默认 150dpi；渲染结果过小（多半是空白或低对比度页）的页改用 220dpi 重渲染
+    - high_res_pages 中的页（0 起始）直接用 220dpi
+    图片体积大且只用于本次 OCR，不进缓存（各页 OCR 结果按图片内容缓存）。
+    """
     if fitz is None:
         return []
 
-    images: List[bytes] = []
     try:
         doc = fitz.open(stream=pdf_bytes, filetype="pdf")
         page_count = min(len(doc), max_pages)
-        for i in range(page_count):
-            page = doc[i]
-            pix = page.get_pixmap(dpi=180, alpha=False)
-            images.append(pix.tobytes("png"))
+        images = _render_pages(doc, list(range(page_count)), _BASE_MATRIX)
+        retry = [
+            i for i in range(page_count)
+            if i in high_res_pages or len(images[i]) < MIN_PAGE_IMAGE_BYTES
+        ]
+        for i, image in zip(retry, _render_pages(doc, retry, _RETRY_MATRIX)):
+            images[i] = image
         doc.close()
     except Exception:
         return []
@@ -137,31 +258,48 @@ def _extract_pdf_with_gpt4o(
     pdf_bytes: bytes,
     model: str = "gpt-4o-mini",
     max_pages: int = 8,
+    max_workers: int = OCR_MAX_WORKERS,
 ) -> str:
     """
     PDF OCR 策略：
     1) 先直接抽取文本型 PDF
-    2) 若文本太少，则按页转图片再用 GPT-4o OCR
+    2) 若文本太少，则按页转图片再用 GPT-4o OCR（各页并发请求，结果按页码顺序合并）
     """
-    direct_text = _extract_pdf_text_direct(pdf_bytes)
+    digest = _sha256(pdf_bytes)
+    direct_text = _extract_pdf_text_direct(pdf_bytes, digest)
 
     # 文本型 PDF 直接抽取足够时，优先使用，成本最低
     if len(direct_text) >= 80:
         return direct_text
 
-    page_images = _pdf_to_png_pages(pdf_bytes, max_pages=max_pages)
+    page_images = _pdf_to_page_images(pdf_bytes, max_pages=max_pages)
     if not page_images:
         return direct_text or "[PDF 无法解析：缺少可用解析器]"
 
-    blocks: List[str] = []
-    for idx, img in enumerate(page_images, start=1):
-        page_text = _ocr_image_with_gpt4o(
+    def ocr_page(img: bytes) -> str:
+        return _ocr_image_with_gpt4o(
             client=client,
             image_bytes=img,
-            mime="image/png",
+            mime=PAGE_IMAGE_MIME,
             model=model,
         )
-        blocks.append(f"[第{idx}页]\n{page_text}")
+
+    # 每页是独立的网络请求，线程池并发后总耗时约等于最慢的一页；map 保持页码顺序
+    with ThreadPoolExecutor(max_workers=max(1, min(len(page_images), max_workers))) as executor:
+        page_texts = list(executor.map(ocr_page, page_images))
+
+        # 识别出的文字过少的页，用更高分辨率重渲染后再识别一次，取较长的结果
+        sparse = tuple(i for i, text in enumerate(page_texts) if len(text.strip()) < MIN_PAGE_OCR_CHARS)
+        if sparse:
+            high_res = _pdf_to_page_images(pdf_bytes, max_pages=max_pages, high_res_pages=sparse)
+            # 已经是高分辨率渲染的页（图片未变化）不再重复识别
+            retry_indexes = [i for i in sparse if i < len(high_res) and high_res[i] != page_images[i]]
+            retry_images = [high_res[i] for i in retry_indexes]
+            for i, text in zip(retry_indexes, executor.map(ocr_page, retry_images)):
+                if len(text.strip()) > len(page_texts[i].strip()):
+                    page_texts[i] = text
+
+    blocks = [f"[第{idx}页]\n{page_text}" for idx, page_text in enumerate(page_texts, start=1)]
 
     merged_ocr = "\n\n".join(blocks).strip()
     if direct_text:
@@ -169,23 +307,74 @@ def _extract_pdf_with_gpt4o(
     return merged_ocr
 
 
+_ASCII_WHITESPACE = b" \t\n\r\x0b\x0c"
+
+
+def _decode_text_upload(content: bytes) -> str:
+    """
+    文本类上传解码：先在 bytes 上跳过 BOM 与首尾 ASCII 空白，再通过 memoryview 切片只解码一次，
+    避免 decode 后再 strip 产生第二份完整副本；首尾残留的 Unicode 空白（如全角空格）再补一次 strip。
+    """
+    start, end = 0, len(content)
+    if content.startswith(codecs.BOM_UTF8):
+        start = len(codecs.BOM_UTF8)
+    while start < end and content[start] in _ASCII_WHITESPACE:
+        start += 1
+    while end > start and content[end - 1] in _ASCII_WHITESPACE:
+        end -= 1
+
+    text = str(memoryview(content)[start:end], "utf-8", "ignore")
+    if text and (text[0].isspace() or text[-1].isspace()):
+        text = text.strip()
+    return text
+
+
+UploadContent = Union[bytes, BinaryIO]
+
+
+def _read_upload_bytes(content: UploadContent) -> bytes:
+    if isinstance(content, (bytes, bytearray, memoryview)):
+        return bytes(content)
+    content.seek(0)
+    return content.read()
+
+
+def _decode_text_stream(stream: BinaryIO) -> str:
+    """文本类上传（文件对象）：按块增量解码，不先整体读成 bytes；utf-8-sig 顺带去掉 BOM。"""
+    stream.seek(0)
+    wrapper = io.TextIOWrapper(stream, encoding="utf-8-sig", errors="ignore")
+    try:
+        return wrapper.read().strip()
+    finally:
+        # 只解绑不关闭，底层文件由调用方（如 UploadFile）负责关闭
+        wrapper.detach()
+
+
 def extract_text_from_upload_with_gpt4o(
     client: OpenAI,
     filename: str,
-    content: bytes,
+    content: UploadContent,
     model: str = "gpt-4o-mini",
     max_pdf_pages: int = 8,
 ) -> str:
     """
-    上传文件统一文本提取入口：
-    - txt/md/csv/json/xml：直接解码
+    上传文件统一文本提取入口（content 可以是 bytes，也可以是二进制文件对象，如 UploadFile.file）：
+    - txt/md/csv/json/xml：直接解码（文件对象按块流式解码）
     - image：GPT-4o OCR
     - pdf：先文本提取，再 GPT-4o OCR 扫描页
     """
     suffix = Path(filename).suffix.lower()
 
     if suffix in TEXT_SUFFIX:
-        return content.decode("utf-8", errors="ignore").strip()
+        if isinstance(content, (bytes, bytearray, memoryview)):
+            return _decode_text_upload(bytes(content))
+        return _decode_text_stream(content)
+
+    if suffix not in IMAGE_MIME_MAP and suffix != ".pdf":
+        return "[暂不支持的文件类型]"
+
+    # 图片要整体做 base64，PDF 要整体交给 PyMuPDF，这两类在这里才读出字节
+    content = _read_upload_bytes(content)
 
     if suffix in IMAGE_MIME_MAP:
         return _ocr_image_with_gpt4o(
@@ -203,4 +392,22 @@ def extract_text_from_upload_with_gpt4o(
             max_pages=max_pdf_pages,
         )
 
-    return "[暂不支持的文件类型]"
+
+async def extract_text_from_upload_async(
+    client: OpenAI,
+    filename: str,
+    content: UploadContent,
+    model: str = "gpt-4o-mini",
+    max_pdf_pages: int = 8,
+) -> str:
+    """extract_text_from_upload_with_gpt4o 的异步版本：解析与 OCR 在线程中进行，不阻塞事件循环。"""
+    # 直接提交到默认线程池：省去 to_thread 的上下文拷贝与 partial 包装
+    return await asyncio.get_running_loop().run_in_executor(
+        None,
+        extract_text_from_upload_with_gpt4o,
+        client,
+        filename,
+        content,
+        model,
+        max_pdf_pages,
+    )
@@ -1,11 +1,23 @@
 from __future__ import annotations
 
 import json
+from functools import lru_cache
 from typing import Any, Dict, Tuple
 
+# 可选：orjson 序列化更快，且默认输出 UTF-8（不转义中文）
+try:
+    import orjson
+except ImportError:
+    orjson = None  # type: ignore[assignment]
+
 
 def _to_json(value: Any) -> str:
     """统一 JSON 序列化（保留中文）。"""
+    if orjson is not None:
+        try:
+            return orjson.dumps(value).decode("utf-8")
+        except TypeError:
+            pass
     return json.dumps(value, ensure_ascii=False)
 
 
@@ -15,6 +27,214 @@ def _normalize_doc_context(document_context: str) -> str:
     return text if text else "无上传参考材料"
 
 
+@lru_cache(maxsize=32)
+def _doc_context_json(document_context: str) -> str:
+    """同一轮里各智能体使用同一份上传材料，规范化 + 序列化结果按原文缓存。"""
+    return _to_json(_normalize_doc_context(document_context))
+
+
+# ---------------------------------------------------------------------------
+# 静态提示词前缀
+# OpenAI 会自动缓存请求中“逐字节相同”的前缀（>=1024 tokens 生效）。
+# 因此所有固定内容（平台规则、字段字典、科室划分、急症信号、输出结构）
+# 都放在 system prompt 中并保持为模块常量；病人/轮次相关的动态内容
+# 一律放在 user prompt 末尾，保证前缀在不同请求间完全一致。
+# ---------------------------------------------------------------------------
+
+_SHARED_PREAMBLE = (
+    "【平台说明】\n"
+    "你是“智能医疗问诊工作流”中的一个智能体。工作流由四个智能体依次协作：\n"
+    "1) 询问智能体（Intake Agent）：采集并补全问诊信息；\n"
+    "2) 路由智能体（Router Agent）：将患者分诊到最合适的科室；\n"
+    "3) 专科智能体（Specialist Agent）：以指定科室视角给出初步分析；\n"
+    "4) 总结智能体（Summary Agent）：整合为患者可读的最终总结。\n"
+    "所有结论仅作健康参考，不能替代医生面诊与处方。\n\n"
+    "【病历字段字典】\n"
+    "- age：年龄（整数，单位岁；未知为 null）\n"
+    "- sex：生理性别（male / female / other；未知为 null）\n"
+    "- chief_complaint：主诉，即最主要的不适（必填）\n"
+    "- duration：持续时间，例如“3天”“1周”（必填）\n"
+    "- severity：严重程度，轻/中/重或 0-10 分（必填）\n"
+    "- symptoms：伴随症状列表\n"
+    "- allergies：药物或食物过敏史列表\n"
+    "- chronic_diseases：慢性病史列表\n"
+    "- current_meds：当前用药列表\n"
+    "- additional_notes：其他补充信息\n\n"
+    "【可选科室】\n"
+    "- 呼吸科：咳嗽、咳痰、气短、喘息、胸闷等呼吸道症状为主\n"
+    "- 心血管科：胸痛、心悸、心慌、心率异常、血压异常等心血管症状为主\n"
+    "- 消化内科：腹痛、腹泻、反酸、胃痛、恶心、呕吐等消化症状为主\n"
+    "- 全科：信息不足、症状交叉明显或不属于以上科室\n\n"
+    "【急症信号】\n"
+    "胸痛、呼吸困难、意识不清、昏迷、抽搐、咯血、高热不退。"
+    "出现以上任一情况时，必须提醒患者立即急诊就医。\n\n"
+    "【通用安全规则】\n"
+    "1) 不做确定性诊断，只描述“可能方向”或“初步判断”。\n"
+    "2) 禁止给出药物剂量、频次、疗程，用药只写“可与医生讨论的方向”。\n"
+    "3) 若上传材料与用户最新描述冲突，以用户最新描述为准。\n"
+    "4) 信息不确定时不要猜测，保持为空。\n"
+    "5) 面向患者的文字一律使用简体中文，清晰、易懂。\n"
+    "6) 你必须只输出严格 JSON，不允许输出 JSON 之外的任何文字。\n\n"
+)
+
+INTAKE_SYSTEM_PROMPT = _SHARED_PREAMBLE + (
+    "【当前角色：询问智能体（Intake Agent）】\n"
+    "你的职责是采集和补全问诊信息，不做诊断、不做开药。\n"
+    "请根据“历史对话 + 既有病历 + 上传参考材料”抽取并更新 patient_info。\n\n"
+    "输出 JSON（严格按此结构）：\n"
+    "{\n"
+    '  "patient_info": {\n'
+    '    "age": null,\n'
+    '    "sex": null,\n'
+    '    "chief_complaint": "",\n'
+    '    "duration": "",\n'
+    '    "severity": "",\n'
+    '    "symptoms": [],\n'
+    '    "allergies": [],\n'
+    '    "chronic_diseases": [],\n'
+    '    "current_meds": [],\n'
+    '    "additional_notes": ""\n'
+    "  },\n"
+    '  "is_complete": true,\n'
+    '  "missing_fields": [],\n'
+    '  "missing_questions": []\n'
+    "}\n\n"
+    "规则：\n"
+    "1) 只做信息采集，不要给诊断结论，不要给药物建议。\n"
+    "2) is_complete=true 的条件：chief_complaint、duration、severity 三项都有明确内容。\n"
+    "3) missing_fields 只能从以下字段中选择："
+    "age, sex, chief_complaint, duration, severity, symptoms, allergies, chronic_diseases, current_meds。\n"
+    "4) missing_questions 必须是给患者看的中文完整问题，且尽量包含示例；"
+    "禁止只输出英文键名（例如 severity）。\n"
+    "5) 若上传材料与用户最新描述冲突，可在 additional_notes 中记录冲突信息。"
+)
+
+ROUTER_SYSTEM_PROMPT = _SHARED_PREAMBLE + (
+    "【当前角色：路由智能体（Router Agent）】\n"
+    "你需要根据患者信息分诊到一个最合适的科室：呼吸科、心血管科、消化内科、全科。\n\n"
+    "请输出 JSON：\n"
+    "{\n"
+    '  "department": "呼吸科|心血管科|消化内科|全科",\n'
+    '  "reason": "",\n'
+    '  "confidence": 0.0,\n'
+    '  "key_evidence": []\n'
+    "}\n\n"
+    "分诊规则：\n"
+    "1) 按【可选科室】中的症状划分，选择主要症状对应的科室。\n"
+    "2) 信息不足或症状交叉明显时，路由到全科。\n"
+    "3) confidence 取值 0-1，表示对分诊结果的把握程度。\n"
+    "4) reason 请用中文写清楚，便于患者理解。"
+)
+
+SPECIALIST_SYSTEM_PROMPT = _SHARED_PREAMBLE + (
+    "【当前角色：专科智能体（Specialist Agent）】\n"
+    "请以 department 指定科室的专科视角，"
+    "给出初步分析、可能方向、建议检查、可讨论的常见用药方向。\n\n"
+    "请输出 JSON：\n"
+    "{\n"
+    '  "preliminary_assessment": "",\n'
+    '  "possible_diagnoses": [],\n'
+    '  "recommended_checks": [],\n'
+    '  "medication_suggestions": [\n'
+    '    {"name": "", "purpose": "", "otc": true}\n'
+    "  ],\n"
+    '  "risk_alerts": []\n'
+    "}\n\n"
+    "要求：\n"
+    "1) preliminary_assessment 用中文，面向患者可读。\n"
+    "2) possible_diagnoses 只写“可能方向”，不要写“已确诊”。\n"
+    "3) medication_suggestions 仅写“可与医生讨论的药物方向”，"
+    "禁止剂量、频次、疗程。\n"
+    "4) risk_alerts 必须包含就医边界（何时应立即就医）。"
+)
+
+SUMMARY_SYSTEM_PROMPT = _SHARED_PREAMBLE + (
+    "【当前角色：开药诊断总结智能体（Summary Agent）】\n"
+    "请将现有信息整合为患者可读总结，必须包含安全提醒和就医边界。\n\n"
+    "请输出 JSON：\n"
+    "{\n"
+    '  "diagnosis_summary": "",\n'
+    '  "prescription_advice": [],\n'
+    '  "home_care": [],\n'
+    '  "follow_up": [],\n'
+    '  "emergency_signs": [],\n'
+    '  "disclaimer": ""\n'
+    "}\n\n"
+    "要求：\n"
+    "1) diagnosis_summary 用中文简明描述“当前初步判断”。\n"
+    "2) prescription_advice 仅写“可与医生讨论”的建议，"
+    "禁止出现具体处方剂量、频次、疗程。\n"
+    "3) home_care 写清楚可执行的居家护理建议。\n"
+    "4) follow_up 写明复诊时机（例如 2-3 天无缓解或加重时复诊）。\n"
+    "5) emergency_signs 写明立即就医信号（例如持续胸痛、呼吸困难、意识改变）。\n"
+    "6) disclaimer 必须明确：不能替代医生面诊与处方。"
+)
+
+COMBINED_SYSTEM_PROMPT = _SHARED_PREAMBLE + (
+    "【当前角色：分诊-专科-总结合并智能体】\n"
+    "询问已完成。请一次性完成路由、专科分析与最终总结三个环节，"
+    "三个环节按顺序进行，后一环节以前一环节的结论为准。\n\n"
+    "请输出 JSON，包含三个带标签的部分：\n"
+    "{\n"
+    '  "route": {\n'
+    '    "department": "呼吸科|心血管科|消化内科|全科",\n'
+    '    "reason": "",\n'
+    '    "confidence": 0.0,\n'
+    '    "key_evidence": []\n'
+    "  },\n"
+    '  "specialist_result": {\n'
+    '    "preliminary_assessment": "",\n'
+    '    "possible_diagnoses": [],\n'
+    '    "recommended_checks": [],\n'
+    '    "medication_suggestions": [{"name": "", "purpose": "", "otc": true}],\n'
+    '    "risk_alerts": []\n'
+    "  },\n"
+    '  "final_result": {\n'
+    '    "diagnosis_summary": "",\n'
+    '    "prescription_advice": [],\n'
+    '    "home_care": [],\n'
+    '    "follow_up": [],\n'
+    '    "emergency_signs": [],\n'
+    '    "disclaimer": ""\n'
+    "  }\n"
+    "}\n\n"
+    "【route】按【可选科室】选择一个科室；confidence 取值 0-1；"
+    "信息不足或症状交叉明显时选全科并降低 confidence。\n"
+    "【specialist】以 route.department 的专科视角给出初步分析、可能方向、建议检查、"
+    "可讨论的用药方向；risk_alerts 必须包含就医边界。\n"
+    "【summary】整合以上内容为患者可读总结；follow_up 写明复诊时机，"
+    "emergency_signs 写明立即就医信号，disclaimer 必须明确不能替代医生面诊与处方。"
+)
+
+
+# ---------------------------------------------------------------------------
+# user prompt 模板：导入时确定结构，调用时只做 format_map 替换
+# ---------------------------------------------------------------------------
+
+_INTAKE_USER_TEMPLATE = (
+    "existing_info = {existing_info}\n"
+    "history = \n{history}\n"
+    "uploaded_reference = {doc_context}"
+)
+_ROUTER_USER_TEMPLATE = (
+    "patient_info = {patient_info}\n"
+    "uploaded_reference = {doc_context}"
+)
+_SPECIALIST_USER_TEMPLATE = (
+    "department = {department}\n"
+    "patient_info = {patient_info}\n"
+    "route = {route}\n"
+    "uploaded_reference = {doc_context}"
+)
+_SUMMARY_USER_TEMPLATE = (
+    "patient_info = {patient_info}\n"
+    "route = {route}\n"
+    "specialist_result = {specialist_result}\n"
+    "uploaded_reference = {doc_context}"
+)
+_COMBINED_USER_TEMPLATE = _ROUTER_USER_TEMPLATE
+
+
 def build_intake_prompts(
     history_text: str,
     existing_info: Dict[str, Any],
@@ -25,48 +245,14 @@ def build_intake_prompts(
     - 只负责采集信息，不做诊断、不做开药
     - 输出严格 JSON
     """
-    doc_context = _normalize_doc_context(document_context)
-
-    system_prompt = (
-        "你是“询问智能体（Intake Agent）”。"
-        "你的职责是采集和补全问诊信息，不做诊断、不做开药。"
-        "你必须只输出严格 JSON，不允许输出 JSON 之外的任何文字。"
+    user_prompt = _INTAKE_USER_TEMPLATE.format_map(
+        {
+            "existing_info": _to_json(existing_info),
+            "history": history_text,
+            "doc_context": _doc_context_json(document_context),
+        }
     )
-
-    user_prompt = (
-        "请根据“历史对话 + 既有病历 + 上传参考材料”抽取并更新 patient_info。\n"
-        "输出 JSON（严格按此结构）：\n"
-        "{\n"
-        '  "patient_info": {\n'
-        '    "age": null,\n'
-        '    "sex": null,\n'
-        '    "chief_complaint": "",\n'
-        '    "duration": "",\n'
-        '    "severity": "",\n'
-        '    "symptoms": [],\n'
-        '    "allergies": [],\n'
-        '    "chronic_diseasesn'
-        '    "additional_notes": ""\n'
-        "  },\n"
-        '  "is_complete": true,\n'
-        '  "missing_fields": [],\n'
-        '  "missing_questions": []\n'
-        "}\n\n"
-        "规则：\n"
-        "1) 只做信息采集，不要给诊断结论，不要给药物建议。\n"
-        "2) is_complete=true 的条件：chief_complaint、duration、severity 三项都有明确内容。\n"
-        "3) missing_fields 只能从以下字段中选择："
-        "age, sex, chief_complaint, duration, severity, symptoms, allergies, chronic_diseases, current_meds。\n"
-        "4) missing_questions 必须是给患者看的中文完整问题，且尽量包含示例；"
-        "禁止只输出英文键名（例如 severity）。\n"
-        "5) 若上传材料与用户最新描述冲突，以用户最新描述为准；"
-        "可在 additional_notes 中记录冲突信息。\n"
-        "6) 信息不确定时不要猜测，保持为空。\n\n"
-        f"existing_info = {_to_json(existing_info)}\n"
-        f"history = \n{history_text}\n"
-        f"uploaded_reference = {_to_json(doc_context)}"
-    )
-    return system_prompt, user_prompt
+    return INTAKE_SYSTEM_PROMPT, user_prompt
 
 
 def build_router_prompts(
@@ -78,34 +264,10 @@ def build_router_prompts(
     - 在 呼吸科 / 心血管科 / 消化内科 / 全科 中选择一个
     - 输出严格 JSON
     """
-    doc_context = _normalize_doc_context(document_context)
-
-    system_prompt = (
-        "你是“路由智能体（Router Agent）”。"
-        "你需要根据患者信息分诊到一个最合适的科室："
-        "呼吸科、心血管科、消化内科、全科。"
-        "你必须只输出严格 JSON。"
-    )
-
-    user_prompt = (
-        "请输出 JSON：\n"
-        "{\n"
-        '  "department": "呼吸科|心血管科|消化内科|全科",\n'
-        '  "reason": "",\n'
-        '  "confidence": 0.0,\n'
-        '  "key_evidence": []\n'
-        "}\n\n"
-        "分诊规则：\n"
-        "1) 咳嗽、咳痰、气短、喘息等呼吸道症状为主时，优先呼吸科。\n"
-        "2) 胸痛、心悸、心慌、血压异常等心血管症状为主时，优先心血管科。\n"
-        "3) 腹痛、腹泻、反酸、恶心、呕吐等消化症状为主时，优先消化内科。\n"
-        "4) 信息不足或症状交叉明显时，路由到全科。\n"
-        "5) 若上传材料与用户最新主诉冲突，以用户最新主诉为准。\n"
-        "6) reason 请用中文写清楚，便于患者理解。\n\n"
-        f"patient_info = {_to_json(patient_info)}\n"
-        f"uploaded_reference = {_to_json(doc_context)}"
+    user_prompt = _ROUTER_USER_TEMPLATE.format_map(
+        {"patient_info": _to_json(patient_info), "doc_context": _doc_context_json(document_context)}
     )
-    return system_prompt, user_prompt
+    return ROUTER_SYSTEM_PROMPT, user_prompt
 
 
 def build_specialist_prompts(
@@ -118,40 +280,17 @@ def build_specialist_prompts(
     专科智能体提示词：
     - 给出初步分析、可能诊断方向、检查建议、可讨论的用药方向
     - 不给具体处方剂量/频次/疗程
+    - 科室放在 user prompt 中，保证 system prompt 在各科室间一致
     """
-    doc_context = _normalize_doc_context(document_context)
-
-    system_prompt = (
-        f"你是“{department}专科智能体（Specialist Agent）”。"
-        "请给出初步分析、可能方向、建议检查、可讨论的常见用药方向。"
-        "不要给出确定性诊断；不要给出药物剂量、频次、疗程。"
-        "你必须只输出严格 JSON。"
-    )
-
-    user_prompt = (
-        "请输出 JSON：\n"
-        "{\n"
-        '  "preliminary_assessment": "",\n'
-        '  "possible_diagnoses": [],\n'
-        '  "recommended_checks": [],\n'
-        '  "medication_suggestions": [\n'
-        '    {"name": "", "purpose": "", "otc": true}\n'
-        "  ],\n"
-        '  "risk_alerts": []\n'
-        "}\n\n"
-        "要求：\n"
-        "1) preliminary_assessment 用中文，面向患者可读。\n"
-        "2) possible_diagnoses 只写“可能方向”，不要写“已确诊”。\n"
-        "3) medication_suggestions 仅写“可与医生讨论的药物方向”，"
-        "禁止剂量、频次、疗程。\n"
-        "4) risk_alerts 必n"
-        "4) risk_alerts 必须包含就医边界（何时应立即就医）。\n"
-        "5) 若上传材料与用户最新主诉冲突，以用户最新主诉为准。\n\n"
-        f"patient_info = {_to_json(patient_info)}\n"
-        f"route = {_to_json(route)}\n"
-        f"uploaded_reference = {_to_json(doc_context)}"
+    user_prompt = _SPECIALIST_USER_TEMPLATE.format_map(
+        {
+            "department": department,
+            "patient_info": _to_json(patient_info),
+            "route": _to_json(route),
+            "doc_context": _doc_context_json(document_context),
+        }
     )
-    return system_prompt, user_prompt
+    return SPECIALIST_SYSTEM_PROMPT, user_prompt
 
 
 def build_summary_prompts(
@@ -165,36 +304,27 @@ def build_summary_prompts(
     - 输出患者可读的最终总结
     - 必须包含安全边界声明
     """
-    doc_context = _normalize_doc_context(document_context)
-
-    system_prompt = (
-        "你是“开药诊断总结智能体（Summary Agent）”。"
-        "请将现有信息整合为患者可读总结，必须包含安全提醒和就医边界。"
-        "你必须只输出严格 JSON。"
+    user_prompt = _SUMMARY_USER_TEMPLATE.format_map(
+        {
+            "patient_info": _to_json(patient_info),
+            "route": _to_json(route),
+            "specialist_result": _to_json(specialist_result),
+            "doc_context": _doc_context_json(document_context),
+        }
     )
+    return SUMMARY_SYSTEM_PROMPT, user_prompt
 
-    user_prompt = (
-        "请输出 JSON：\n"
-        "{\n"
-        '  "diagnosis_summary": "",\n'
-        '  "prescription_advice": [],\n'
-        '  "home_care": [],\n'
-        '  "follow_up": [],\n'
-        '  "emergency_signs": [],\n'
-        '  "disclaimer": ""\n'
-        "}\n\n"
-        "要求：\n"
-        "1) diagnosis_summary 用中文简明描述“当前初步判断”。\n"
-        "2) prescription_advice 仅写“可与医生讨论”的建议，"
-        "禁止出现具体处方剂量、频次、疗程。\n"
-        "3) home_care 写清楚可执行的居家护理建议。\n"
-        "4) follow_up 写明复诊时机（例如 2-3 天无缓解或加重时复诊）。\n"
-        "5) emergency_signs 写明立即就医信号（例如持续胸痛、呼吸困难、意识改变）。\n"
-        "6) disclaimer 必须明确：不能替代医生面诊与处方。\n"
-        "7) 若上传材料与用户最新主诉冲突，以用户最新主诉为准。\n\n"
-        f"patient_info = {_to_json(patient_info)}\n"
-        f"route = {_to_json(route)}\n"
-        f"specialist_result = {_to_json(specialist_result)}\n"
-        f"uploaded_reference = {_to_json(doc_context)}"
+
+def build_combined_prompts(
+    patient_info: Dict[str, Any],
+    document_context: str = "无上传参考材料",
+) -> Tuple[str, str]:
+    """
+    合并智能体提示词：
+    - 一次调用同时产出 route / specialist_result / final_result
+    - 输出严格 JSON
+    """
+    user_prompt = _COMBINED_USER_TEMPLATE.format_map(
+        {"patient_info": _to_json(patient_info), "doc_context": _doc_context_json(document_context)}
     )
-    return system_prompt, user_prompt
+    return COMBINED_SYSTEM_PROMPT, user_prompt
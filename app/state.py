@@ -32,10 +32,20 @@ class PatientInfo(TypedDict, total=False):
     additional_notes: str
 
 
+class IntakeResult(TypedDict, total=False):
+    """询问智能体的原始 JSON 输出。"""
+    patient_info: PatientInfo
+    is_complete: bool
+    missing_fields: List[str]
+    missing_questions: List[str]
+
+
 class RouteDecision(TypedDict, total=False):
     """路由智能体输出。"""
     department: Department
     reason: str
+    confidence: float
+    key_evidence: List[str]
 
 
 class MedicationSuggestion(TypedDict, total=False):
@@ -64,6 +74,13 @@ class FinalResult(TypedDict, total=False):
     disclaimer: str
 
 
+class CombinedResult(TypedDict, total=False):
+    """合并智能体的原始 JSON 输出。"""
+    route: RouteDecision
+    specialist_result: SpecialistResult
+    final_result: FinalResult
+
+
 class MedState(TypedDict, total=False):
     """
     LangGraph 全局状态：
@@ -90,6 +107,12 @@ class MedState(TypedDict, total=False):
     # 上传文件提取后的文本，供路由/专科/总结使用
     documents_text: List[str]
 
+    # Intake 阶段由 documents_text 构建一次的参考材料上下文，后续智能体直接复用
+    _document_context: str
+
+    # Intake 对 history 逐条格式化后的缓存行（与 history 下标对齐），跨轮增量更新
+    _history_lines: List[str]
+
 
 def create_initial_state() -> MedState:
     """初始化 state，避免主程序里重复写。"""
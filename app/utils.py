@@ -1,9 +1,27 @@
 from __future__ import annotations
 
-from typing import Any, Dict, List
+import re
+from typing import Any, Callable, Dict, FrozenSet, List, Tuple
+
+# 可选：pyahocorasick 一次扫描命中全部关键词（含相互重叠的词）；未安装时退回正则
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None  # type: ignore[assignment]
 
 from app.state import Department, FinalResult, PatientInfo
 
+# 分诊关键词表：标签 -> 关键词。新增规则组只需加一个标签，调用方按标签判断
+RED_FLAG_TAG = "red_flag"
+KEYWORD_RULES: Dict[str, Tuple[str, ...]] = {
+    RED_FLAG_TAG: ("胸痛", "呼吸困难", "意识不清", "昏迷", "抽搐", "咯血", "高热不退"),
+    "呼吸科": ("咳", "喘", "呼吸", "痰", "气短", "胸闷"),
+    "心血管科": ("胸痛", "心悸", "心慌", "心率", "血压", "心口"),
+    "消化内科": ("腹痛", "腹泻", "反酸", "胃痛", "恶心", "呕吐"),
+}
+# 关键词兜底路由的科室优先级
+FALLBACK_DEPARTMENTS: Tuple[Department, ...] = ("呼吸科", "心血管科", "消化内科")
+
 
 def history_to_text(history: List[Dict[str, str]], limit: int = 12) -> str:
     """将最近 N 条历史消息转成字符串，供 LLM 理解上下文。"""
@@ -19,12 +37,13 @@ def as_str_list(value: Any) -> List[str]:
     """将任意值安全转换为字符串列表，并去重。"""
     if not isinstance(value, list):
         return []
-    result: List[str] = []
+    # dict 保序去重，O(n)
+    seen: Dict[str, None] = {}
     for item in value:
         text = str(item).strip()
-        if text and text not in result:
-            result.append(text)
-    return result
+        if text:
+            seen.setdefault(text, None)
+    return list(seen)
 
 
 def merge_patient_info(old_info: PatientInfo, new_info: Dict[str, Any]) -> PatientInfo:
@@ -38,11 +57,9 @@ def merge_patient_info(old_info: PatientInfo, new_info: Dict[str, Any]) -> Patie
         if value in (None, "", [], {}):
             continue
         if isinstance(value, list):
-            old_values = as_str_list(merged.get(key, []))
-            for item in as_str_list(value):
-                if item not in old_values:
-                    old_values.append(item)
-            merged[key] = old_values
+            # 旧值在前、新值在后，一次遍历完成转换与去重
+            old_values = merged.get(key)
+            merged[key] = as_str_list((old_values if isinstance(old_values, list) else []) + value)
         else:
             merged[key] = value
     return merged  # type: ignore[return-value]
@@ -51,20 +68,20 @@ def merge_patient_info(old_info: PatientInfo, new_info: Dict[str, Any]) -> Patie
 def route_fallback(patient_info: Dict[str, Any]) -> Department:
     """
     当路由智能体输出异常时，使用关键词兜底路由。
+    各字段分别交给关键词扫描器（不再拼接整段文本），命中多个科室时按 FALLBACK_DEPARTMENTS 的优先级取第一个。
     """
-    text_parts = [
+    tags: set = set()
+    for text in (
         str(patient_info.get("chief_complaint", "")),
         str(patient_info.get("additional_notes", "")),
-        " ".join(as_str_list(patient_info.get("symptoms", []))),
-    ]
-    text = " ".join(text_parts).lower()
-
-    if any(k in text for k in ["咳", "喘", "呼吸", "痰", "气短", "胸闷"]):
-        return "呼吸科"
-    if any(k in text for k in ["胸痛", "心悸", "心慌", "心率", "血压", "心口"]):
-        return "心血管科"
-    if any(k in text for k in ["腹痛", "腹泻", "反酸", "胃痛", "恶心", "呕吐"]):
-        return "消化内科"
+        *as_str_list(patient_info.get("symptoms", [])),
+    ):
+        if text:
+            tags |= scan_keyword_tags(text)
+
+    for department in FALLBACK_DEPARTMENTS:
+        if department in tags:
+            return department
     return "全科"
 
 
@@ -104,4 +121,45 @@ def build_document_context(documents_text: List[str], max_chars: int = 3000) ->
     if not cleaned:
         return "无上传参考材料"
     merged = "\n\n".join([f"参考材料{i+1}:\n{text}" for i, text in enumerate(cleaned)])
-    return merged[:max_chars]
\ No newline at end of file
+    return merged[:max_chars]
+
+
+def _build_keyword_scanner(rules: Dict[str, Tuple[str, ...]]) -> Callable[[str], FrozenSet[str]]:
+    """导入时把全部规则组编译成一个自动机（或一条正则），之后每段文本只扫描一遍。"""
+    word_tags: Dict[str, set] = {}
+    for tag, words in rules.items():
+        for word in words:
+            word_tags.setdefault(word, set()).add(tag)
+
+    if ahocorasick is not None:
+        automaton = ahocorasick.Automaton()
+        for word, tags in word_tags.items():
+            automaton.add_word(word, frozenset(tags))
+        automaton.make_automaton()
+
+        def scan(text: str) -> FrozenSet[str]:
+            found: set = set()
+            for _, tags in automaton.iter(text):
+                found |= tags
+            return frozenset(found)
+
+        return scan
+
+    # 正则每个位置只取最长的词，因此把被包含的短词标签并入长词（如“呼吸困难”也带上“呼吸”的标签）
+    closed_tags = {
+        word: frozenset().union(*(tags for other, tags in word_tags.items() if other in word))
+        for word in word_tags
+    }
+    words = sorted(word_tags, key=len, reverse=True)
+    pattern = re.compile("(?=(" + "|".join(map(re.escape, words)) + "))")
+
+    def scan(text: str) -> FrozenSet[str]:
+        found: set = set()
+        for match in pattern.finditer(text):
+            found |= closed_tags[match.group(1)]
+        return frozenset(found)
+
+    return scan
+
+
+scan_keyword_tags = _build_keyword_scanner(KEYWORD_RULES)
@@ -1,43 +1,61 @@
 from __future__ import annotations
 
-from typing import Literal
+import threading
+import weakref
+from typing import Any, Literal
 
 from langgraph.graph import END, StateGraph
 
-from app.agents import IntakeAgent, RouterAgent, SpecialistAgent, SummaryAgent
+from app.agents import CombinedAgent, IntakeAgent
 from app.llm_client import LLMClient
 from app.state import MedState
 
+# 按 llm 实例缓存已编译的工作流；智能体不持有请求级状态，可跨会话复用。
+# 以实例本身（弱引用）为键而不是 id(llm)，避免实例回收后 id 被复用时拿到绑定旧实例的图
+_WORKFLOW_CACHE: "weakref.WeakKeyDictionary[LLMClient, Any]" = weakref.WeakKeyDictionary()
+_WORKFLOW_CACHE_LOCK = threading.Lock()
 
-def _after_intake(state: MedState) -> Literal["ask_more", "to_router"]:
+
+def _after_intake(state: MedState) -> Literal["ask_more", "to_combined"]:
     """
     Intake 节点后的条件分支：
     - ask_user_more: 信息不足，结束本轮，等待用户继续补充
-    - 其他情况: 进入 Router 节点
+    - 其他情况: 进入 Combined 节点
     """
     next_action = str(state.get("next_action", "")).strip()
     if next_action == "ask_user_more":
         return "ask_more"
-    return "to_router"
+    return "to_combined"
 
 
 def create_workflow(llm: LLMClient):
     """
-    创建四智能体工作流：
-    intake -> (END 或 router) -> specialist -> summary -> END
+    获取（首次调用时创建并编译）工作流，同一个 llm 复用同一份编译结果。
+    """
+    with _WORKFLOW_CACHE_LOCK:
+        workflow = _WORKFLOW_CACHE.get(llm)
+        if workflow is None:
+            workflow = _build_workflow(llm)
+            _WORKFLOW_CACHE[llm] = workflow
+    return workflow
+
+
+def _build_workflow(llm: LLMClient):
+    """
+    创建工作流：
+    intake -> (END 或 combined) -> END
+    combined 一次调用同时产出 route / specialist_result / final_result，
+    分诊把握不足或输出不完整时在节点内部回退到 router -> specialist -> summary 逐个调用。
+    main.py 的 SSE 接口不使用本工作流（只复用 create_initial_state），自行分阶段调用各智能体。
     """
     intake_agent = IntakeAgent(llm)
-    router_agent = RouterAgent(llm)
-    specialist_agent = SpecialistAgent(llm)
-    summary_agent = SummaryAgent(llm)
+    combined_agent = CombinedAgent(llm)
 
     graph = StateGraph(MedState)
 
     # 1) 注册节点
     graph.add_node("intake", intake_agent)
-    graph.add_node("router", router_agent)
-    graph.add_node("specialist", specialist_agent)
-    graph.add_node("summary", summary_agent)
+    graph.add_node("combined", combined_agent)
 
     # 2) 设置入口
     graph.set_entry_point("intake")
@@ -47,15 +65,13 @@ def create_workflow(llm: LLMClient):
         "intake",
         _after_intake,
         {
-            "ask_more": END,      # 先结束，等待用户补充信息
-            "to_router": "router" # 信息足够，继续主流程
+            "ask_more": END,            # 先结束，等待用户补充信息
+            "to_combined": "combined",  # 信息足够，继续主流程
         },
     )
 
     # 4) 主干链路
-    graph.add_edge("router", "specialist")
-    graph.add_edge("specialist", "summary")
-    graph.add_edge("summary", END)
+    graph.add_edge("combined", END)
 
     # 5) 编译工作流
     return graph.compile()
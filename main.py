@@ -3,18 +3,27 @@ from __future__ import annotations
 import asyncio
 import json
 import os
+import time
 import uuid
-from typing import Any, AsyncGenerator, Callable, Dict, List, TypedDict
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncGenerator, Callable, Dict, List, NamedTuple, Tuple, TypedDict
 
 from fastapi import FastAPI, File, Form, HTTPException, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 
+# 可选：orjson 直接输出 UTF-8 bytes（不转义中文），未安装时退回标准库
+try:
+    import orjson
+except ImportError:
+    orjson = None  # type: ignore[assignment]
+
 from app.agents import IntakeAgent, RouterAgent, SpecialistAgent, SummaryAgent
 from app.config import AppConfig
 from app.llm_client import LLMClient
-from app.ocr_gpt4o import extract_text_from_upload_with_gpt4o
+from app.ocr_gpt4o import extract_text_from_upload_async
 
 try:
     from app.workflow import create_initial_state as _create_initial_state
@@ -30,10 +39,70 @@ class ConsultStreamRequest(BaseModel):
 class SessionBucket(TypedDict):
     state: Dict[str, Any]
     documents: List[Dict[str, Any]]
+    # 已完成的用户轮次数，在提交 state 时递增，快照直接读取，不再扫描 history
+    user_turns: int
+    # 清洗后的 documents_text 缓存，上传新文档时置空，下次问诊时惰性重建
+    documents_text_cache: List[str] | None
+    # 同一会话的问诊轮次串行执行：各轮原地修改同一个 state，并发会互相覆盖 / 回滚
+    lock: asyncio.Lock
+
+
+class StateSnapshot(NamedTuple):
+    """返回给前端的会话状态快照；route 在构建时校验一次，前端可直接读取 department。"""
+
+    session_id: str
+    next_action: str
+    case_status: str
+    followup_round: int
+    route: Dict[str, Any]
+    department: str
+    doc_count: int
 
 
 AgentCallable = Callable[[Dict[str, Any]], Dict[str, Any]]
 
+
+class SessionStore:
+    """
+    会话存储：按最近访问时间排序的有界 LRU。
+    - 超过 max_sessions 时淘汰最久未访问的会话
+    - 超过 ttl_seconds 未访问的会话在下次访问存储时顺带清理，无需后台线程
+    """
+
+    def __init__(self, max_sessions: int, ttl_seconds: float) -> None:
+        self.max_sessions = max(1, max_sessions)
+        self.ttl_seconds = ttl_seconds
+        self._data: "OrderedDict[str, Tuple[float, SessionBucket]]" = OrderedDict()
+
+    def _evict_expired(self, now: float) -> None:
+        if self.ttl_seconds <= 0:
+            return
+        deadline = now - self.ttl_seconds
+        while self._data:
+            oldest_sid, (accessed_at, _) = next(iter(self._data.items()))
+            if accessed_at >= deadline:
+                break
+            del self._data[oldest_sid]
+
+    def get(self, sid: str) -> SessionBucket | None:
+        now = time.monotonic()
+        self._evict_expired(now)
+        entry = self._data.get(sid)
+        if entry is None:
+            return None
+        self._data[sid] = (now, entry[1])
+        self._data.move_to_end(sid)
+        return entry[1]
+
+    def set(self, sid: str, bucket: SessionBucket) -> None:
+        self._data[sid] = (time.monotonic(), bucket)
+        self._data.move_to_end(sid)
+        while len(self._data) > self.max_sessions:
+            self._data.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
 app = FastAPI(title="Medical Workflow API (True Token SSE)")
 
 app.add_middleware(
@@ -52,11 +121,26 @@ router_agent = RouterAgent(llm)
 specialist_agent = SpecialistAgent(llm)
 summary_agent = SummaryAgent(llm)
 
-SESSION_DB: Dict[str, SessionBucket] = {}
+SESSION_DB = SessionStore(
+    max_sessions=int(os.getenv("MAX_SESSIONS", "10000")),
+    ttl_seconds=float(os.getenv("SESSION_TTL_SECONDS", "3600")),
+)
 
 OCR_MODEL = os.getenv("OCR_MODEL", "gpt-4o-mini")
 OCR_MAX_PDF_PAGES = int(os.getenv("OCR_MAX_PDF_PAGES", "8"))
+# 多文件上传时并发解析 / OCR，信号量限制全进程同时在跑的提取任务数
+OCR_CONCURRENCY = max(1, int(os.getenv("OCR_CONCURRENCY", "4")))
+OCR_SEMAPHORE = asyncio.Semaphore(OCR_CONCURRENCY)
 STAGE_HEARTBEAT_SECONDS = float(os.getenv("SSE_STAGE_HEARTBEAT_SECONDS", "0.8"))
+# 流式回复合并窗口：攒够字符数或等待超过时间窗即发一帧（字符数 <= 0 时逐 token 发送）
+TOKEN_FLUSH_CHARS = int(os.getenv("SSE_TOKEN_FLUSH_CHARS", "32"))
+TOKEN_FLUSH_SECONDS = float(os.getenv("SSE_TOKEN_FLUSH_SECONDS", "0.025"))
+
+# 各阶段的阻塞调用统一跑在有界线程池中，并发会话多时不会无限制地创建线程
+STAGE_POOL = ThreadPoolExecutor(
+    max_workers=int(os.getenv("STAGE_POOL_WORKERS", "8")),
+    thread_name_prefix="stage",
+)
 
 STAGE_NAME_MAP = {
     "intake": "询问智能体",
@@ -74,6 +158,20 @@ STAGE_TIPS = {
 }
 
 
+_STATE_KEY_FACTORIES: Tuple[Tuple[str, Callable[[], Any]], ...] = (
+    ("history", list),
+    ("patient_info", dict),
+    ("documents_text", list),
+    ("user_input", str),
+    ("assistant_reply", str),
+    ("route", dict),
+    ("specialist_result", dict),
+    ("final_result", dict),
+    ("_document_context", str),
+    ("_history_lines", list),
+)
+
+
 def _new_state() -> Dict[str, Any]:
     if callable(_create_initial_state):
         state = dict(_create_initial_state())
@@ -85,9 +183,10 @@ def _new_state() -> Dict[str, Any]:
             "next_action": "continue",
         }
 
-    state.setdefault("history", [])
-    state.setdefault("patient_info", {})
-    state.setdefault("documents_text", [])
+    # 一次性预置各阶段会写入的全部键（空值与缺省等价），后续合并阶段结果时 state 不再扩容
+    for key, factory in _STATE_KEY_FACTORIES:
+        if key not in state:
+            state[key] = factory()
     state.setdefault("next_action", "continue")
     return state
 
@@ -97,16 +196,68 @@ def _get_bucket(session_id: str) -> SessionBucket:
     if not sid:
         raise HTTPException(status_code=400, detail="session_id 不能为空")
 
-    if sid not in SESSION_DB:
-        SESSION_DB[sid] = {"state": _new_state(), "documents": []}
-    return SESSION_DB[sid]
+    bucket = SESSION_DB.get(sid)
+    if bucket is None:
+        bucket = {
+            "state": _new_state(),
+            "documents": [],
+            "user_turns": 0,
+            "documents_text_cache": None,
+            "lock": asyncio.Lock(),
+        }
+        SESSION_DB.set(sid, bucket)
+    return bucket
+
+
+def _documents_text(bucket: SessionBucket) -> List[str]:
+    """
+    返回会话的参考材料文本列表，只在文档变化后重建一次。
+    返回的列表在多轮之间共享，各阶段只读不改。
+    """
+    cached = bucket["documents_text_cache"]
+    if cached is None:
+        # 每份文档只 str + strip 一次，过滤与取值共用同一结果
+        cached = [
+            text
+            for text in (str(d.get("extracted_text") or "").strip() for d in bucket["documents"])
+            if text
+        ]
+        bucket["documents_text_cache"] = cached
+    return cached
+
+
+def _sse(payload: Dict[str, Any]) -> bytes:
+    if orjson is not None:
+        return b"data: " + orjson.dumps(payload) + b"\n\n"
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode("utf-8")
+
+
+# 结束哨兵帧与响应头都是常量，预先构造好，每次请求直接复用
+_SSE_DONE = b"data: [DONE]\n\n"
+_SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "Connection": "keep-alive",
+    "X-Accel-Buffering": "no",
+}
+
+# token 事件是最高频的帧：固定前后缀预先编码好，只对 token 本身做 JSON 字符串转义
+_TOKEN_PREFIX = b'data: {"type":"token","content":"'
+_TOKEN_SUFFIX = b'"}\n\n'
 
 
-def _sse(payload: Dict[str, Any]) -> str:
-    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+def _emit_token(token: str) -> bytes:
+    if orjson is not None:
+        body = orjson.dumps(token)[1:-1]
+    else:
+        body = json.dumps(token, ensure_ascii=False)[1:-1].encode("utf-8")
+    return _TOKEN_PREFIX + body + _TOKEN_SUFFIX
 
 
-def _chunk_text(text: str, size: int = 12):
+# 非流式文本（追问 / 兜底回复）的切块大小：保留少量分帧的打字效果，不再人为 sleep
+REPLY_CHUNK_CHARS = 64
+
+
+def _chunk_text(text: str, size: int = REPLY_CHUNK_CHARS):
     if not text:
         yield ""
         return
@@ -116,19 +267,34 @@ def _chunk_text(text: str, size: int = 12):
 
 def _append_history(state: Dict[str, Any], role: str, content: str) -> None:
     history = state.get("history")
-    if not isinstance(history, list):
-        history = []
+    if type(history) is not list:
+        history = state["history"] = []
     history.append({"role": role, "content": content})
-    state["history"] = history
 
 
-def _build_progress_message(stage_key: str, tick: int) -> str:
+def _format_progress_message(stage_key: str, tick: int) -> str:
     tips = STAGE_TIPS.get(stage_key, ["处理中"])
     tip = tips[tick % len(tips)]
     elapsed = int((tick + 1) * STAGE_HEARTBEAT_SECONDS)
     return f"{tip} (约 {elapsed}s)"
 
 
+# 心跳文案只取决于 (阶段, tick)，导入时预先生成前 PROGRESS_CACHE_TICKS 条
+PROGRESS_CACHE_TICKS = 32
+_PROGRESS_CACHE: Dict[Tuple[str, int], str] = {
+    (stage_key, tick): _format_progress_message(stage_key, tick)
+    for stage_key in STAGE_TIPS
+    for tick in range(PROGRESS_CACHE_TICKS)
+}
+
+
+def _build_progress_message(stage_key: str, tick: int) -> str:
+    message = _PROGRESS_CACHE.get((stage_key, tick))
+    if message is None:
+        message = _format_progress_message(stage_key, tick)
+    return message
+
+
 def _infer_case_status(next_action: str) -> str:
     if next_action == "ask_user_more":
         return "collecting"
@@ -137,39 +303,51 @@ def _infer_case_status(next_action: str) -> str:
     return "in_progress"
 
 
-def _build_state_snapshot(
-    session_id: str,
-    state: Dict[str, Any],
-    docs: List[Dict[str, Any]],
-) -> Dict[str, Any]:
-    history = state.get("history", [])
-    if not isinstance(history, list):
-        history = []
+def _build_state_snapshot(session_id: str, bucket: SessionBucket) -> Dict[str, Any]:
+    state = bucket["state"]
+    route = state.get("route")
+    if type(route) is not dict:
+        route = {}
+    next_action = str(state.get("next_action") or "continue")
 
-    followup_round = sum(
-        1 for item in history if isinstance(item, dict) and item.get("role") == "user"
-    )
+    return StateSnapshot(
+        session_id,
+        next_action,
+        _infer_case_status(next_action),
+        bucket["user_turns"],
+        route,
+        str(route.get("department") or ""),
+        len(bucket["documents"]),
+    )._asdict()
 
-    route = state.get("route", {})
-    if not isinstance(route, dict):
-        route = {}
 
-    next_action = str(state.get("next_action") or "continue")
+_MISSING = object()
 
-    return {
-        "session_id": session_id,
-        "next_action": next_action,
-        "case_status": _infer_case_status(next_action),
-        "followup_round": followup_round,
-        "route": route,
-        "doc_count": len(docs),
-    }
+
+def _record_undo(undo: Dict[str, Any], state: Dict[str, Any], keys) -> None:
+    """记录本轮首次覆盖前的旧值（同一键只记一次），失败时据此回滚。"""
+    for key in keys:
+        if key not in undo:
+            undo[key] = state.get(key, _MISSING)
+
+
+def _rollback_turn(state: Dict[str, Any], undo: Dict[str, Any], history_len: int) -> None:
+    """撤销本轮对会话 state 的原地修改：恢复被覆盖的键，并截掉本轮追加的历史。"""
+    for key, value in undo.items():
+        if value is _MISSING:
+            state.pop(key, None)
+        else:
+            state[key] = value
+    history = state.get("history")
+    if type(history) is list:
+        del history[history_len:]
 
 
 async def _run_blocking_stage(
     state: Dict[str, Any],
     stage_key: str,
     stage_callable: AgentCallable,
+    undo: Dict[str, Any] | None = None,
 ) -> AsyncGenerator[Dict[str, Any], None]:
     stage_name = STAGE_NAME_MAP.get(stage_key, stage_key)
 
@@ -180,10 +358,12 @@ async def _run_blocking_stage(
         "message": "已启动",
     }
 
-    task = asyncio.create_task(asyncio.to_thread(stage_callable, state))
+    # run_in_executor 返回的 Future 本身即可 await / done()，无需再包一层 Task
+    fut = asyncio.get_running_loop().run_in_executor(STAGE_POOL, stage_callable, state)
     tick = 0
 
-    while not task.done():
+    # 等待任务完成或心跳超时，任务一结束立即继续，不再睡满整个心跳间隔
+    while not fut.done():
         yield {
             "type": "stage_progress",
             "stage": stage_key,
@@ -191,13 +371,15 @@ async def _run_blocking_stage(
             "message": _build_progress_message(stage_key, tick),
         }
         tick += 1
-        await asyncio.sleep(STAGE_HEARTBEAT_SECONDS)
+        await asyncio.wait({fut}, timeout=STAGE_HEARTBEAT_SECONDS)
 
-    update = await task
+    update = await fut
     if not isinstance(update, dict):
         raise RuntimeError(f"{stage_name} 返回结果不是 dict")
 
-    state.update(update)
+    if undo is not None:
+        _record_undo(undo, state, update)
+    state |= update
 
     preview = str(state.get("assistant_reply") or "").strip().replace("\n", " ")
     if len(preview) > 80:
@@ -238,18 +420,29 @@ async def upload_documents(
         raise HTTPException(status_code=400, detail="files 不能为空")
 
     bucket = _get_bucket(sid)
-    saved_docs: List[Dict[str, Any]] = []
 
-    for file in files:
-        file_bytes = await file.read()
-        filename = (file.filename or "unnamed").strip() or "unnamed"
+    async def _extract(file: UploadFile, filename: str) -> str:
+        # 上传时即在线程中完成解析 / OCR（结果按内容哈希缓存），不阻塞其它会话的流式输出，
+        # 用户随后发起问诊时参考材料已就绪。
+        # 直接传 UploadFile 底层的临时文件（大文件已落盘），不先 await file.read() 整体读入内存
+        async with OCR_SEMAPHORE:
+            text = await extract_text_from_upload_async(
+                client=llm.client,
+                filename=filename,
+                content=file.file,
+                model=OCR_MODEL,
+                max_pdf_pages=OCR_MAX_PDF_PAGES,
+            )
+        return str(text or "").strip()
 
-        extracted_text = extract_text_from_upload_with_gpt4o(
-            client=llm.client,
-            filename_pages=OCR_MAX_PDF_PAGES,
-        )
-        extracted_text = str(extracted_text or "").strip()
+    filenames = [(file.filename or "unnamed").strip() or "unnamed" for file in files]
+    # 多个文件的 OCR 并发进行，总耗时约为最慢的一个而不是逐个累加；结果按上传顺序返回
+    texts = await asyncio.gather(
+        *(_extract(file, filename) for file, filename in zip(files, filenames))
+    )
 
+    saved_docs: List[Dict[str, Any]] = []
+    for file, filename, extracted_text in zip(files, filenames, texts):
         doc = {
             "doc_id": str(uuid.uuid4()),
             "filename": filename,
@@ -257,6 +450,7 @@ async def upload_documents(
             "extracted_text": extracted_text,
         }
         bucket["documents"].append(doc)
+        bucket["documents_text_cache"] = None
 
         saved_docs.append(
             {
@@ -287,15 +481,21 @@ async def consult_stream(req: ConsultStreamRequest):
 
     bucket = _get_bucket(sid)
 
-    async def event_generator() -> AsyncGenerator[str, None]:
+    async def event_generator() -> AsyncGenerator[bytes, None]:
+        # 直接原地修改会话 state，不再整体复制；会话锁覆盖整轮（含提交 / 回滚），
+        # 重复提交或断线重试的请求排队等上一轮结束，不会与之共享半轮的 state。
+        # 本轮覆盖过的键记入 undo，异常或客户端断开时回滚，只有走到提交点才算生效
+        lock = bucket["lock"]
+        await lock.acquire()
+        state = bucket["state"]
+        history = state.get("history")
+        history_len = len(history) if type(history) is list else 0
+        undo: Dict[str, Any] = {}
+        committed = False
         try:
-            state = dict(bucket["state"])
+            _record_undo(undo, state, ("user_input", "documents_text", "history"))
             state["user_input"] = user_input
-            state["documents_text"] = [
-                str(d.get("extracted_text", "")).strip()
-                for d in bucket["documents"]
-                if str(d.get("extracted_text", "")).strip()
-            ]
+            state["documents_text"] = _documents_text(bucket)
             _append_history(state, "user", user_input)
 
             yield _sse(
@@ -306,17 +506,17 @@ async def consult_stream(req: ConsultStreamRequest):
                 }
             )
 
-            async for evt in _run_blocking_stage(state, "intake", intake_agent):
+            async for evt in _run_blocking_stage(state, "intake", intake_agent, undo):
                 yield _sse(evt)
 
             if str(state.get("next_action") or "") == "ask_user_more":
                 assistant_reply = str(state.get("assistant_reply") or "请补充更多信息。")
-                for part in _chunk_text(assistant_reply, size=10):
-                    yield _sse({"type": "token", "content": part})
-                    await asyncio.sleep(0.01)
+                for part in _chunk_text(assistant_reply):
+                    yield _emit_token(part)
 
-                bucket["state"] = state
-                snapshot = _build_state_snapshot(sid, state, bucket["documents"])
+                committed = True
+                bucket["user_turns"] += 1
+                snapshot = _build_state_snapshot(sid, bucket)
 
                 yield _sse(
                     {
@@ -327,16 +527,16 @@ async def consult_stream(req: ConsultStreamRequest):
                         "state": snapshot,
                     }
                 )
-                yield "data: [DONE]\n\n"
+                yield _SSE_DONE
                 return
 
-            async for evt in _run_blocking_stage(state, "router", router_agent):
+            async for evt in _run_blocking_stage(state, "router", router_agent, undo):
                 yield _sse(evt)
 
-            async for evt in _run_blocking_stage(state, "specialist", specialist_agent):
+            async for evt in _run_blocking_stage(state, "specialist", specialist_agent, undo):
                 yield _sse(evt)
 
-            async for evt in _run_blocking_stage(state, "summary_structured", summary_agent.prepare):
+            async for evt in _run_blocking_stage(state, "summary_structured", summary_agent.prepare, undo):
                 yield _sse(evt)
 
             yield _sse(
@@ -350,11 +550,15 @@ async def consult_stream(req: ConsultStreamRequest):
 
             assistant_reply = ""
             try:
-                for token in summary_agent.stream_reply(state):
+                async for token in summary_agent.stream_reply_async(
+                    state,
+                    flush_chars=TOKEN_FLUSH_CHARS,
+                    flush_interval=TOKEN_FLUSH_SECONDS,
+                ):
                     if not token:
                         continue
                     assistant_reply += token
-                    yield _sse({"type": "token", "content": token})
+                    yield _emit_token(token)
             except Exception as exc:
                 yield _sse(
                     {
@@ -367,10 +571,9 @@ async def consult_stream(req: ConsultStreamRequest):
 
             if not assistant_reply.strip():
                 fallback = summary_agent.fallback_reply(state)
-                for part in _chunk_text(fallback, size=10):
-                    assistant_reply += part
-                    yield _sse({"type": "token", "content": part})
-                    await asyncio.sleep(0.01)
+                for part in _chunk_text(fallback):
+                    yield _emit_token(part)
+                assistant_reply = fallback
 
             yield _sse(
                 {
@@ -385,8 +588,9 @@ async def consult_stream(req: ConsultStreamRequest):
             state["next_action"] = "done"
             _append_history(state, "assistant", assistant_reply)
 
-            bucket["state"] = state
-            snapshot = _build_state_snapshot(sid, state, bucket["documents"])
+            committed = True
+            bucket["user_turns"] += 1
+            snapshot = _build_state_snapshot(sid, bucket)
 
             yield _sse(
                 {
@@ -397,18 +601,23 @@ async def consult_stream(req: ConsultStreamRequest):
                     "state": snapshot,
                 }
             )
-            yield "data: [DONE]\n\n"
+            yield _SSE_DONE
 
         except Exception as exc:
+            if not committed:
+                _rollback_turn(state, undo, history_len)
             yield _sse({"type": "error", "message": f"工作流异常: {exc}"})
-            yield "data: [DONE]\n\n"
+            yield _SSE_DONE
+        except BaseException:
+            # 客户端断开（GeneratorExit / CancelledError）同样不能留下半轮的修改
+            if not committed:
+                _rollback_turn(state, undo, history_len)
+            raise
+        finally:
+            lock.release()
 
     return StreamingResponse(
         event_generator(),
         media_type="text/event-stream",
-        headers={
-            "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
-            "X-Accel-Buffering": "no",
-        },
+        headers=_SSE_HEADERS,
     )
@@ -8,24 +8,54 @@ import queue
 import threading
 import time
 import uuid
-from typing import Any, Dict, Tuple
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from itertools import islice
+from typing import Any, Callable, Deque, Dict, Iterable, Iterator, List, Tuple
 
+import httpx
 import requests
 import streamlit as st
+from requests.adapters import HTTPAdapter
+
+# 可选：orjson 解析更快，未安装时退回标准库
+try:
+    import orjson
+
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+# 可选：requests-toolbelt 的 MultipartEncoder 边读边发上传文件，未安装时由 requests 整体编码
+try:
+    from requests_toolbelt.multipart.encoder import MultipartEncoder
+except ImportError:
+    MultipartEncoder = None  # type: ignore[assignment]
 
 BACKEND_HOST = os.getenv("BACKEND_HOST", "127.0.0.1")
 BACKEND_PORT = int(os.getenv("BACKEND_PORT", "8000"))
 AUTO_START_BACKEND = os.getenv("AUTO_START_BACKEND", "1") == "1"
 BACKEND_APP_IMPORT = os.getenv("BACKEND_APP_IMPORT", "main:app")
 MAX_SILENCE_SECONDS = int(os.getenv("UI_MAX_SILENCE_SECONDS", "120"))
+# 无后端事件时状态框的重绘间隔（秒），只用于刷新耗时与动画
+STATUS_REDRAW_SECONDS = float(os.getenv("UI_STATUS_REDRAW_SECONDS", "0.5"))
+# 回复区最短重绘间隔（秒）：期间到达的 token 攒起来一次渲染，约 20 次/秒
+ANSWER_RENDER_SECONDS = float(os.getenv("UI_ANSWER_RENDER_SECONDS", "0.05"))
+# 会话消息最多保留条数，以及每次重跑时以聊天气泡渲染的最近条数（更早的折叠显示）
+MAX_STORED_MESSAGES = int(os.getenv("UI_MAX_STORED_MESSAGES", "200"))
+MAX_VISIBLE_MESSAGES = int(os.getenv("UI_MAX_VISIBLE_MESSAGES", "40"))
+# 已上传材料登记表中会话的最长闲置时间（秒），默认与后端 SESSION_TTL_SECONDS 一致
+DOCS_REGISTRY_IDLE_SECONDS = float(os.getenv("UI_DOCS_IDLE_SECONDS", "3600"))
 
 API_BASE_URL = os.getenv("API_BASE_URL", f"http://{BACKEND_HOST}:{BACKEND_PORT}").rstrip("/")
 UPLOAD_URL = f"{API_BASE_URL}/api/documents/upload"
 STREAM_URL = f"{API_BASE_URL}/api/consult/stream"
 HEALTH_PATHS = ("/api/health", "/health")
 
-SPINNER_FRAMES = ["-", "\\", "|", "/"]
-PULSE_FRAMES = [".", "..", "...", "....", "...", ".."]
+# 动画帧统一补齐到 16 帧，取帧用 frame & _FRAME_MASK 代替取模与 len()
+_FRAME_MASK = 15
+SPINNER_FRAMES = ("-", "\\", "|", "/") * 4
+PULSE_FRAMES = (".", "..", "...", "....", "....", "...", "..", ".") * 2
 
 STARTUP_MESSAGE = (
     "你好，我是智能医疗问诊助手。\n"
@@ -37,45 +67,69 @@ def _new_session_id() -> str:
     return str(uuid.uuid4())
 
 
-def _format_duration(seconds: float) -> str:
-    total_seconds = max(0, int(seconds))
+def _format_duration_raw(total_seconds: int) -> str:
     minutes, secs = divmod(total_seconds, 60)
     if minutes > 0:
         return f"{minutes}分{secs}秒"
     return f"{secs}秒"
 
 
-def _build_live_status_text(
-    frame_index: int,
-    stage_name: str,
-    stage_mode: str,
-    workflow_start_at: float,
-    stage_start_at: float,
-    last_backend_event_at: float,
-    extra_message: str = "",
-) -> str:
-    now = time.time()
-    stage_elapsed = _format_duration(now - stage_start_at)
-    total_elapsed = _format_duration(now - workflow_start_at)
-    idle_elapsed = _format_duration(now - last_backend_event_at)
+# 状态框每次重绘要格式化三个耗时，绝大多数落在 10 分钟以内：预先生成，直接查表
+_DUR_CACHE_LIMIT = 600
+_DUR_CACHE = tuple(_format_duration_raw(i) for i in range(_DUR_CACHE_LIMIT))
 
-    spinner = SPINNER_FRAMES[frame_index % len(SPINNER_FRAMES)]
-    pulse = PULSE_FRAMES[frame_index % len(PULSE_FRAMES)]
 
-    text = (
-        f"{spinner} {stage_name} {stage_mode} {pulse}\n\n"
-        f"阶段耗时：{stage_elapsed} ｜ 总耗时：{total_elapsed} ｜ 最近后端更新：{idle_elapsed}前"
-    )
-    if extra_message:
-        text += f"\n\n{extra_message}"
+def _format_duration(seconds: float) -> str:
+    total_seconds = max(0, int(seconds))
+    if total_seconds < _DUR_CACHE_LIMIT:
+        return _DUR_CACHE[total_seconds]
+    return _format_duration_raw(total_seconds)
+
+
+def _status_parts(stage_name: str, stage_mode: str, extra_message: str = "") -> Tuple[str, str]:
+    """阶段信息只在切换阶段时变化：预先拼好前后两段，重绘时只填入动画帧与耗时。"""
+    head = f" {stage_name} {stage_mode} "
+    tail = f"\n\n{extra_message}" if extra_message else ""
+    return head, tail
+
+
+def _paint_status(status_box, text: str, last_text: str) -> str:
+    """文本与上次一致时跳过重绘，避免无意义的前端 diff；返回当前显示的文本。"""
+    if text != last_text:
+        status_box.markdown(text)
     return text
 
 
+@st.cache_resource(show_spinner=False)
+def _http_session() -> requests.Session:
+    """
+    健康检查与上传共用的连接池。Streamlit 每次交互都会重跑脚本，
+    用 cache_resource 保证整个进程只创建一次，跨轮复用 TCP/TLS 连接。
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+@st.cache_resource(show_spinner=False)
+def _stream_client() -> httpx.Client:
+    """
+    流式问诊请求共用的 httpx 连接池（线程安全，可在后台线程中使用）。
+    进程内所有用户共用，只限制空闲 keep-alive 连接数，不限制并发连接，避免问诊排队等连接。
+    """
+    return httpx.Client(
+        timeout=httpx.Timeout(600.0, connect=20.0),
+        limits=httpx.Limits(max_connections=None, max_keepalive_connections=8),
+    )
+
+
 def _backend_health_ok(timeout: float = 1.0) -> bool:
     for health_path in HEALTH_PATHS:
         health_url = f"{API_BASE_URL}{health_path}"
         try:
-            response = requests.get(health_url, timeout=timeout)
+            response = _http_session().get(health_url, timeout=timeout)
             if response.ok:
                 return True
         except Exception:
@@ -141,15 +195,55 @@ def _ensure_backend_ready() -> Tuple[bool, str]:
     return False, "后端启动超时（35秒）"
 
 
+def _new_messages() -> Deque[Dict[str, str]]:
+    return deque([{"role": "assistant", "content": STARTUP_MESSAGE}], maxlen=MAX_STORED_MESSAGES)
+
+
+class _DocsRegistry:
+    """
+    各病例（session_id）已上传材料的登记表，整个进程共享一份，不进 session_state。
+    只淘汰闲置超过 idle_seconds 的会话，活跃用户的列表不会被其它会话挤掉。
+    """
+
+    def __init__(self, idle_seconds: float) -> None:
+        self.idle_seconds = idle_seconds
+        self._lock = threading.Lock()
+        # 按最近访问时间排序，过期清理只需从最旧的一端扫到第一个未过期的会话
+        self._entries: "OrderedDict[str, Tuple[float, List[Dict[str, Any]]]]" = OrderedDict()
+
+    def get(self, session_id: str) -> List[Dict[str, Any]]:
+        now = time.monotonic()
+        with self._lock:
+            if self.idle_seconds > 0:
+                deadline = now - self.idle_seconds
+                while self._entries:
+                    oldest_sid, (accessed_at, _) = next(iter(self._entries.items()))
+                    if accessed_at >= deadline:
+                        break
+                    del self._entries[oldest_sid]
+            entry = self._entries.get(session_id)
+            docs = entry[1] if entry is not None else []
+            self._entries[session_id] = (now, docs)
+            self._entries.move_to_end(session_id)
+            return docs
+
+
+@st.cache_resource(show_spinner=False)
+def _docs_registry_store() -> _DocsRegistry:
+    return _DocsRegistry(idle_seconds=DOCS_REGISTRY_IDLE_SECONDS)
+
+
+def _docs_registry(session_id: str) -> List[Dict[str, Any]]:
+    """返回该会话的材料列表（同一会话跨重跑是同一个 list 对象）；新病例换了 session_id 自然得到新的空表。"""
+    return _docs_registry_store().get(session_id)
+
+
 def _init_state() -> None:
     if "session_id" not in st.session_state:
         st.session_state.session_id = _new_session_id()
 
     if "messages" not in st.session_state:
-        st.session_state.messages = [{"role": "assistant", "content": STARTUP_MESSAGE}]
-
-    if "uploaded_docs" not in st.session_state:
-        st.session_state.uploaded_docs = []
+        st.session_state.messages = _new_messages()
 
     if "state_snapshot" not in st.session_state:
         st.session_state.state_snapshot = {}
@@ -157,8 +251,7 @@ def _init_state() -> None:
 
 def _reset_case() -> None:
     st.session_state.session_id = _new_session_id()
-    st.session_state.messages = [{"role": "assistant", "content": STARTUP_MESSAGE}]
-    st.session_state.uploaded_docs = []
+    st.session_state.messages = _new_messages()
     st.session_state.state_snapshot = {}
 
 
@@ -166,66 +259,399 @@ def _upload_documents(files) -> Dict[str, Any]:
     if not files:
         return {"documents": []}
 
-    multipart_files = [
-        ("files", (uploaded_file.name, uploaded_file.getvalue(), uploaded_file.type or "application/octet-stream"))
-        for uploaded_file in files
-    ]
+    # 直接传 UploadedFile 文件对象，不再 getvalue() 为每个文件复制一份 bytes
+    multipart_files = []
+    for uploaded_file in files:
+        uploaded_file.seek(0)
+        multipart_files.append(
+            ("files", (uploaded_file.name, uploaded_file, uploaded_file.type or "application/octet-stream"))
+        )
 
-    response = requests.post(
-        UPLOAD_URL,
-        data={"session_id": st.session_state.session_id},
-        files=multipart_files,
-        timeout=300,
-    )
+    if MultipartEncoder is not None:
+        encoder = MultipartEncoder(fields=[("session_id", st.session_state.session_id), *multipart_files])
+        response = _http_session().post(
+            UPLOAD_URL,
+            data=encoder,
+            headers={"Content-Type": encoder.content_type},
+            timeout=300,
+        )
+    else:
+        response = _http_session().post(
+            UPLOAD_URL,
+            data={"session_id": st.session_state.session_id},
+            files=multipart_files,
+            timeout=300,
+        )
     if not response.ok:
         raise RuntimeError(f"上传失败({response.status_code}): {response.text}")
-    return response.json()
-
+    return _json_loads(response.content)
+
+
+# SSE 请求显式要求不压缩、不缓存：小 token 帧不必逐块解压，代理也不会为压缩而攒包
+_STREAM_HEADERS = {
+    "Accept": "text/event-stream",
+    "Accept-Encoding": "identity",
+    "Cache-Control": "no-cache",
+}
+_SSE_DATA_PREFIX = b"data:"
+_SSE_DONE = b"[DONE]"
+
+
+def _iter_sse_batches(chunks: Iterable[bytes]) -> Iterator[List[bytes]]:
+    """
+    按 SSE 规范在字节层面解析事件流；每读到一块数据，产出其中完整事件的 data 负载列表（bytes）。
+    - 行尾兼容 \n 与 \r\n，空行分隔事件
+    - 同一事件的多行 data 以 \n 拼接，冒号后的单个空格去掉
+    - 注释行与 event/id/retry 等字段忽略
+    """
+    buf = bytearray()
+    data_lines: List[bytes] = []
+    for chunk in chunks:
+        buf += chunk
+        batch: List[bytes] = []
+        start = 0
+        while True:
+            end = buf.find(b"\n", start)
+            if end < 0:
+                break
+            # 直接在缓冲区上按下标判断前缀、去掉行尾 \r 与冒号后的空格，每行只切片复制一次
+            line_end = end - 1 if end > start and buf[end - 1] == 0x0D else end
+            line_start = start
+            start = end + 1
+
+            if line_end == line_start:
+                if data_lines:
+                    batch.append(data_lines[0] if len(data_lines) == 1 else b"\n".join(data_lines))
+                    data_lines = []
+                continue
 
-def _stream_worker(session_id: str, user_input: str, out_queue: "queue.Queue[Dict[str, Any]]") -> None:
+            if buf.startswith(_SSE_DATA_PREFIX, line_start, line_end):
+                value_start = line_start + 5
+                if value_start < line_end and buf[value_start] == 0x20:
+                    value_start += 1
+                data_lines.append(bytes(buf[value_start:line_end]))
+        if start:
+            del buf[:start]
+        if batch:
+            yield batch
+
+
+def _stream_worker(
+    client: httpx.Client,
+    session_id: str,
+    user_input: str,
+    out_queue: "queue.Queue[List[Dict[str, Any]]]",
+    ready: threading.Event,
+    stop: threading.Event,
+) -> None:
     payload = {"session_id": session_id, "user_input": user_input}
 
+    def _emit(events: List[Dict[str, Any]]) -> None:
+        # 同一次网络读取解析出的事件整批入队，每批只付一次加锁与唤醒的开销；
+        # 先入队再置位，UI 线程被唤醒时保证能取到这批事件
+        out_queue.put(events)
+        ready.set()
+
     try:
-        with requests.post(STREAM_URL, json=payload, stream=True, timeout=(20, 600)) as response:
-            if not response.ok:
-                out_queue.put({"type": "error", "message": f"请求失败({response.status_code}): {response.text}"})
+        with client.stream("POST", STREAM_URL, json=payload, headers=_STREAM_HEADERS) as response:
+            if not response.is_success:
+                response.read()
+                _emit([{"type": "error", "message": f"请求失败({response.status_code}): {response.text}"}])
                 return
 
-            for raw_line in response.iter_lines(decode_unicode=True):
-                if not raw_line:
-                    continue
-
-                line = raw_line.strip()
-                if not line.startswith("data:"):
-                    continue
-
-                data_str = line[5:].strip()
-                if data_str == "[DONE]":
+            # 不传 chunk_size：httpx 会把数据攒满定长块才交出，小的 token 帧会被憋住；
+            # 不定长时每次直接拿到 socket 一次读到的全部字节（最多 64 KiB），多帧一起切分
+            for batch in _iter_sse_batches(response.iter_bytes()):
+                # UI 侧已放弃本轮（如超时）时尽快退出，关闭连接归还连接池
+                if stop.is_set():
+                    break
+                events: List[Dict[str, Any]] = []
+                done = False
+                for data in batch:
+                    if data == _SSE_DONE:
+                        done = True
+                        break
+
+                    try:
+                        event = _json_loads(data)
+                    except ValueError:
+                        continue
+
+                    if isinstance(event, dict):
+                        events.append(event)
+
+                if events:
+                    _emit(events)
+                if done:
                     break
-
-                try:
-                    event = json.loads(data_str)
-                except json.JSONDecodeError:
-                    continue
-
-                if isinstance(event, dict):
-                    out_queue.put(event)
 
     except Exception as exc:
-        out_queue.put({"type": "error", "message": f"流式连接异常: {exc}"})
+        _emit([{"type": "error", "message": f"流式连接异常: {exc}"}])
     finally:
-        out_queue.put({"type": "_worker_done"})
+        _emit([{"type": "_worker_done"}])
+
+
+@st.cache_data(show_spinner=False)
+def _doc_list_markdown(docs: Tuple[Tuple[str, int], ...]) -> str:
+    """已接入材料列表只在上传后变化：按 (文件名, 字数) 元组缓存拼好的文本，用一个 caption 渲染。"""
+    return "  \n".join(f"- {filename} ({char_count} 字)" for filename, char_count in docs)
 
 
 def _render_sidebar_snapshot(snapshot: Dict[str, Any]) -> None:
-    route = snapshot.get("route", {}) if isinstance(snapshot.get("route"), dict) else {}
+    department = snapshot.get("department")
+    if department is None:
+        # 兼容旧后端：快照里只有嵌套的 route
+        route = snapshot.get("route") or {}
+        department = route.get("department") if isinstance(route, dict) else None
     st.write("next_action:", snapshot.get("next_action", "-"))
     st.write("case_status:", snapshot.get("case_status", "-"))
     st.write("followup_round:", snapshot.get("followup_round", "-"))
-    st.write("department:", route.get("department", "-"))
+    st.write("department:", department or "-")
     st.write("doc_count:", snapshot.get("doc_count", 0))
 
 
+@dataclass
+class _StreamContext:
+    """一轮问诊流式渲染过程中的可变状态，供各事件处理函数共享。"""
+
+    # st.status 容器（标题随阶段更新）与其内部显示耗时明细的占位符
+    status: Any
+    status_box: Any
+    answer_box: Any
+    workflow_start_at: float
+    stage_name: str = "系统连接"
+    stage_start_at: float = 0.0
+    last_backend_event_at: float = 0.0
+    stage_mode: str = "准备中"
+    stage_extra: str = "正在建立流式连接..."
+    # 流式回复按片段追加到列表，需要完整文本时才 join，避免逐 token 的字符串拼接
+    assistant_chunks: List[str] = field(default_factory=list)
+    final_state: Dict[str, Any] = field(default_factory=dict)
+    runtime_error: str = ""
+    finished: bool = False
+    last_status_text: str = ""
+    last_ui_render_at: float = 0.0
+    # 一批事件处理完后再统一渲染：两个区域的脏标记
+    answer_dirty: bool = False
+    status_dirty: bool = False
+    last_answer_render_at: float = 0.0
+    # 状态文本的分段缓存：阶段信息、整秒耗时、动画帧各自变化时才重建对应部分
+    _status_stage_key: Tuple[str, str, str] | None = None
+    _status_head: str = ""
+    _status_tail: str = ""
+    _status_seconds: Tuple[int, int, int] | None = None
+    _status_elapsed: str = ""
+    _status_frame: int = -1
+    _status_label: str = ""
+
+    def answer_wait(self, now: float) -> float | None:
+        """回复区有待渲染内容时，距离允许下次渲染还需等待的秒数。"""
+        if not self.answer_dirty:
+            return None
+        return max(0.0, ANSWER_RENDER_SECONDS - (now - self.last_answer_render_at))
+
+    @property
+    def assistant_text(self) -> str:
+        """拼出当前完整回复，并把片段列表压成一段，下次 join 只需处理新增片段。"""
+        chunks = self.assistant_chunks
+        if len(chunks) > 1:
+            chunks[:] = ["".join(chunks)]
+        return chunks[0] if chunks else ""
+
+    def flush_answer(self) -> None:
+        if self.answer_dirty:
+            self.answer_box.markdown(self.assistant_text)
+            self.answer_dirty = False
+            self.last_answer_render_at = time.time()
+
+    def render(self) -> None:
+        """每批事件后调用一次：回复区按节流间隔重绘，状态框有变化才重绘。"""
+        if self.answer_wait(time.time()) == 0.0:
+            self.flush_answer()
+        if self.status_dirty:
+            self.paint_status()
+
+    def invalidate_status(self) -> None:
+        """状态框被其它内容覆盖后调用，保证下次 paint_status 一定重绘。"""
+        self.last_status_text = ""
+        self._status_frame = -1
+
+    def paint_status(self) -> None:
+        self.status_dirty = False
+        now = time.time()
+        self.last_ui_render_at = now
+
+        # 动画帧按时间推进（每个重绘间隔一帧），耗时按整秒显示：两者都没变就不必重建文本
+        frame = int((now - self.workflow_start_at) / STATUS_REDRAW_SECONDS)
+        stage_key = (self.stage_name, self.stage_mode, self.stage_extra)
+        seconds = (
+            int(now - self.stage_start_at),
+            int(now - self.workflow_start_at),
+            int(now - self.last_backend_event_at),
+        )
+        if frame == self._status_frame and stage_key == self._status_stage_key and seconds == self._status_seconds:
+            return
+
+        if stage_key != self._status_stage_key:
+            self._status_stage_key = stage_key
+            self._status_head, self._status_tail = _status_parts(*stage_key)
+            label = f"{self.stage_name} · {self.stage_mode}"
+            if label != self._status_label:
+                # 阶段切换只改容器标题，明细仍写在内部占位符里
+                self._status_label = label
+                self.status.update(label=label, state="running")
+        if seconds != self._status_seconds:
+            self._status_seconds = seconds
+            stage_elapsed, total_elapsed, idle_elapsed = (_format_duration(x) for x in seconds)
+            self._status_elapsed = (
+                f"\n\n阶段耗时：{stage_elapsed} ｜ 总耗时：{total_elapsed} ｜ 最近后端更新：{idle_elapsed}前"
+            )
+        self._status_frame = frame
+
+        text = (
+            SPINNER_FRAMES[frame & _FRAME_MASK]
+            + self._status_head
+            + PULSE_FRAMES[frame & _FRAME_MASK]
+            + self._status_elapsed
+            + self._status_tail
+        )
+        self.last_status_text = _paint_status(self.status_box, text, self.last_status_text)
+
+
+def _on_worker_done(event: Dict[str, Any], ctx: _StreamContext) -> None:
+    ctx.finished = True
+
+
+def _on_error(event: Dict[str, Any], ctx: _StreamContext) -> None:
+    ctx.runtime_error = event.get("message") or "未知错误"
+    ctx.finished = True
+
+
+def _on_meta(event: Dict[str, Any], ctx: _StreamContext) -> None:
+    ctx.stage_name = "会话初始化"
+    ctx.stage_start_at = time.time()
+    ctx.stage_mode = "已连接"
+    ctx.stage_extra = f"已连接后端，当前接入材料 {event.get('doc_count', 0)} 份"
+    ctx.status_dirty = True
+
+
+def _on_stage_start(event: Dict[str, Any], ctx: _StreamContext) -> None:
+    ctx.stage_name = event.get("stage_name") or "智能体"
+    ctx.stage_start_at = time.time()
+    ctx.stage_mode = "启动中"
+    ctx.stage_extra = (event.get("message") or "").strip() or "阶段已启动"
+    ctx.status_dirty = True
+
+
+def _on_stage_progress(event: Dict[str, Any], ctx: _StreamContext) -> None:
+    ctx.stage_name = event.get("stage_name") or "智能体"
+    ctx.stage_mode = "处理中"
+    ctx.stage_extra = (event.get("message") or "").strip() or "正在处理中"
+    ctx.status_dirty = True
+
+
+def _on_stage_done(event: Dict[str, Any], ctx: _StreamContext) -> None:
+    now = time.time()
+    stage_name = event.get("stage_name") or "智能体"
+    done_tip = (event.get("message") or "").strip() or "处理完成"
+    stage_elapsed = _format_duration(now - ctx.stage_start_at)
+    total_elapsed = _format_duration(now - ctx.workflow_start_at)
+    ctx.status_box.success(
+        f"✅ {stage_name} 完成（阶段 {stage_elapsed} / 总计 {total_elapsed}）\n\n{done_tip}"
+    )
+    # 状态框已被 success 覆盖，下次 info 必须重绘；同批次里之前的状态更新也作废
+    ctx.invalidate_status()
+    ctx.status_dirty = False
+    ctx.last_ui_render_at = now
+    ctx.stage_name = "等待下一阶段"
+    ctx.stage_start_at = now
+    ctx.stage_mode = "排队中"
+    ctx.stage_extra = "上一阶段已完成，准备进入下一阶段..."
+
+
+def _on_token(event: Dict[str, Any], ctx: _StreamContext) -> None:
+    # 后端 token 帧的 content 总是 JSON 字符串，解析结果直接就是 str，不再逐帧 str() 转换
+    token = event.get("content")
+    if token:
+        ctx.assistant_chunks.append(token)
+        ctx.answer_dirty = True
+
+    ctx.stage_name = "生成回复"
+    ctx.stage_mode = "输出中"
+    ctx.stage_extra = "正在逐字生成答案..."
+
+
+def _on_final(event: Dict[str, Any], ctx: _StreamContext) -> None:
+    final_reply = (event.get("assistant_reply") or "").strip()
+    if final_reply:
+        ctx.assistant_chunks[:] = [final_reply]
+        ctx.answer_dirty = True
+
+    payload_state = event.get("state")
+    if isinstance(payload_state, dict):
+        ctx.final_state = payload_state
+
+    ctx.stage_name = "结果收尾"
+    ctx.stage_start_at = time.time()
+    ctx.stage_mode = "完成中"
+    ctx.stage_extra = "正在保存本轮状态..."
+
+
+def _on_unknown(event: Dict[str, Any], ctx: _StreamContext) -> None:
+    return None
+
+
+_TOKEN_EVENTS = frozenset({"token", "chunk", "assistant_token"})
+_FINAL_EVENTS = frozenset({"final", "done"})
+
+# 事件类型 -> 处理函数，一次字典查找完成分发
+_EVENT_HANDLERS: Dict[str, Callable[[Dict[str, Any], _StreamContext], None]] = {
+    "_worker_done": _on_worker_done,
+    "error": _on_error,
+    "meta": _on_meta,
+    "stage_start": _on_stage_start,
+    "stage_progress": _on_stage_progress,
+    "stage_done": _on_stage_done,
+    **{name: _on_token for name in _TOKEN_EVENTS},
+    **{name: _on_final for name in _FINAL_EVENTS},
+}
+
+
+@st.fragment
+def _render_upload_panel() -> None:
+    """
+    上传区放在 fragment 里：选择文件、点击上传只重跑这一块，
+    不会连带重绘整段聊天记录与状态快照。
+    """
+    upload_files = st.file_uploader(
+        "支持 png/jpg/jpeg/pdf/txt/md",
+        type=["png", "jpg", "jpeg", "pdf", "txt", "md"],
+        accept_multiple_files=True,
+    )
+
+    if st.button("📤 上传并解析", use_container_width=True, disabled=not upload_files):
+        try:
+            upload_result = _upload_documents(upload_files)
+            documents = upload_result.get("documents", [])
+            if isinstance(documents, list):
+                _docs_registry(st.session_state.session_id).extend(documents)
+            st.success(f"上传成功: 新增 {len(documents)} 份材料")
+        except Exception as exc:
+            st.error(f"上传失败: {exc}")
+
+    uploaded_docs = _docs_registry(st.session_state.session_id)
+    if uploaded_docs:
+        st.markdown("**已接入材料**")
+        st.caption(
+            _doc_list_markdown(
+                tuple(
+                    (document.get("filename", "unnamed"), document.get("char_count", 0))
+                    for document in uploaded_docs[-10:]
+                )
+            )
+        )
+
+
 st.set_page_config(page_title="智能医疗问诊", page_icon="🩺", layout="wide")
 
 backend_ready, backend_message = _ensure_backend_ready()
@@ -256,34 +682,25 @@ with st.sidebar:
     st.divider()
     st.subheader("上传检查单 / 纸质材料")
 
-    upload_files = st.file_uploader(
-        "支持 png/jpg/jpeg/pdf/txt/md",
-        type=["png", "jpg", "jpeg", "pdf", "txt", "md"],
-        accept_multiple_files=True,
-    )
-
-    if st.button("📤 上传并解析", use_container_width=True, disabled=not upload_files):
-        try:
-            upload_result = _upload_documents(upload_files)
-            documents = upload_result.get("documents", [])
-            if isinstance(documents, list):
-                st.session_state.uploaded_docs.extend(documents)
-            st.success(f"上传成功: 新增 {len(documents)} 份材料")
-        except Exception as exc:
-            st.error(f"上传失败: {exc}")
-
-    if st.session_state.uploaded_docs:
-        st.markdown("**已接入材料**")
-        for document in st.session_state.uploaded_docs[-10:]:
-            filename = document.get("filename", "unnamed")
-            char_count = document.get("char_count", 0)
-            st.caption(f"- {filename} ({char_count} 字)")
+    _render_upload_panel()
 
     st.divider()
     st.subheader("状态快照")
     _render_sidebar_snapshot(st.session_state.state_snapshot)
 
-for message in st.session_state.messages:
+# Streamlit 每次交互都会整页重跑：只为最近的消息创建聊天气泡，更早的合并成一段折叠文本
+messages = st.session_state.messages
+hidden_count = max(0, len(messages) - MAX_VISIBLE_MESSAGES)
+if hidden_count:
+    with st.expander(f"更早的 {hidden_count} 条消息"):
+        st.markdown(
+            "\n\n".join(
+                f"**{'用户' if m['role'] == 'user' else '助手'}**：{m['content']}"
+                for m in islice(messages, hidden_count)
+            )
+        )
+
+for message in islice(messages, hidden_count, None):
     with st.chat_message(message["role"]):
         st.markdown(message["content"])
 
@@ -293,177 +710,83 @@ if user_text:
     with st.chat_message("user"):
         st.markdown(user_text)
 
-    assistant_text = ""
-    final_state: Dict[str, Any] = {}
-
     with st.chat_message("assistant"):
-        status_box = st.empty()
-        answer_box = st.empty()
-
         workflow_start_at = time.time()
-        current_stage_name = "系统连接"
-        current_stage_start_at = workflow_start_at
-        last_backend_event_at = workflow_start_at
-        stage_mode = "准备中"
-        stage_extra = "正在建立流式连接..."
-
-        spinner_index = 0
-        runtime_error = ""
+        status = st.status("系统连接 · 准备中", expanded=True)
+        with status:
+            status_detail = st.empty()
+        ctx = _StreamContext(
+            status=status,
+            status_box=status_detail,
+            answer_box=st.empty(),
+            workflow_start_at=workflow_start_at,
+            stage_start_at=workflow_start_at,
+            last_backend_event_at=workflow_start_at,
+        )
 
-        worker_queue: "queue.Queue[Dict[str, Any]]" = queue.Queue()
+        worker_queue: "queue.Queue[List[Dict[str, Any]]]" = queue.Queue()
+        worker_ready = threading.Event()
+        worker_stop = threading.Event()
         worker_thread = threading.Thread(
             target=_stream_worker,
-            args=(st.session_state.session_id, user_text, worker_queue),
+            args=(
+                _stream_client(),
+                st.session_state.session_id,
+                user_text,
+                worker_queue,
+                worker_ready,
+                worker_stop,
+            ),
             daemon=True,
         )
         worker_thread.start()
 
-        status_box.info(
-            _build_live_status_text(
-                frame_index=spinner_index,
-                stage_name=current_stage_name,
-                stage_mode=stage_mode,
-                workflow_start_at=workflow_start_at,
-                stage_start_at=current_stage_start_at,
-                last_backend_event_at=last_backend_event_at,
-                extra_message=stage_extra,
-            )
-        )
-
-        stream_done = False
-        while not stream_done:
-            try:
-                event = worker_queue.get(timeout=0.2)
-            except queue.Empty:
-                if (time.time() - last_backend_event_at) > MAX_SILENCE_SECONDS:
-                    runtime_error = f"后端超过 {MAX_SILENCE_SECONDS} 秒无更新，请稍后重试"
+        ctx.paint_status()
+
+        while not ctx.finished:
+            # 有新事件时立即被唤醒；否则最多等到下一次计划重绘（刷新耗时与动画），
+            # 回复区有被节流挡住的 token 时则等到允许渲染为止
+            now = time.time()
+            wait_seconds = max(0.05, STATUS_REDRAW_SECONDS - (now - ctx.last_ui_render_at))
+            answer_wait = ctx.answer_wait(now)
+            if answer_wait is not None:
+                wait_seconds = min(wait_seconds, answer_wait)
+
+            if worker_ready.wait(timeout=wait_seconds):
+                # 先清标志再取空队列：清除之后到达的事件会重新置位，不会丢失唤醒
+                worker_ready.clear()
+                while not ctx.finished:
+                    try:
+                        events = worker_queue.get_nowait()
+                    except queue.Empty:
+                        break
+
+                    ctx.last_backend_event_at = time.time()
+                    for event in events:
+                        _EVENT_HANDLERS.get(event.get("type"), _on_unknown)(event, ctx)
+                        if ctx.finished:
+                            break
+            else:
+                now = time.time()
+                if (now - ctx.last_backend_event_at) > MAX_SILENCE_SECONDS:
+                    ctx.runtime_error = f"后端超过 {MAX_SILENCE_SECONDS} 秒无更新，请稍后重试"
                     break
+                if now - ctx.last_ui_render_at >= STATUS_REDRAW_SECONDS:
+                    ctx.status_dirty = True
 
-                spinner_index += 1
-                status_box.info(
-                    _build_live_status_text(
-                        frame_index=spinner_index,
-                        stage_name=current_stage_name,
-                        stage_mode=stage_mode,
-                        workflow_start_at=workflow_start_at,
-                        stage_start_at=current_stage_start_at,
-                        last_backend_event_at=last_backend_event_at,
-                        extra_message=stage_extra,
-                    )
-                )
-                continue
-
-            event_type = str(event.get("type", ""))
-
-            if event_type == "_worker_done":
-                stream_done = True
-                continue
-
-            last_backend_event_at = time.time()
-
-            if event_type == "error":
-                runtime_error = str(event.get("message", "未知错误"))
-                break
-
-            if event_type == "meta":
-                doc_count = event.get("doc_count", 0)
-                current_stage_name = "会话初始化"
-                current_stage_start_at = time.time()
-                stage_mode = "已连接"
-                stage_extra = f"已连接后端，当前接入材料 {doc_count} 份"
-                spinner_index += 1
-                status_box.info(
-                    _build_live_status_text(
-                        frame_index=spinner_index,
-                        stage_name=current_stage_name,
-                        stage_mode=stage_mode,
-                        workflow_start_at=workflow_start_at,
-                        stage_start_at=current_stage_start_at,
-                        last_backend_event_at=last_backend_event_at,
-                        extra_message=stage_extra,
-                    )
-                )
-                continue
-
-            if event_type in {"stage_start", "stage_progress", "stage_done"}:
-                stage_name = str(event.get("stage_name", "智能体"))
-                message = str(event.get("message", "")).strip()
-
-                if event_type == "stage_start":
-                    current_stage_name = stage_name
-                    current_stage_start_at = time.time()
-                    stage_mode = "启动中"
-                    stage_extra = message or "阶段已启动"
-                    spinner_index += 1
-                    status_box.info(
-                        _build_live_status_text(
-                            frame_index=spinner_index,
-                            stage_name=current_stage_name,
-                            stage_mode=stage_mode,
-                            workflow_start_at=workflow_start_at,
-                            stage_start_at=current_stage_start_at,
-                            last_backend_event_at=last_backend_event_at,
-                            extra_message=stage_extra,
-                        )
-                    )
-                elif event_type == "stage_progress":
-                    current_stage_name = stage_name
-                    stage_mode = "处理中"
-                    stage_extra = message or "正在处理中"
-                    spinner_index += 1
-                    status_box.info(
-                        _build_live_status_text(
-                            frame_index=spinner_index,
-                            stage_name=current_stage_name,
-                            stage_mode=stage_mode,
-                            workflow_start_at=workflow_start_at,
-                            stage_start_at=current_stage_start_at,
-                            last_backend_event_at=last_backend_event_at,
-                            extra_message=stage_extra,
-                        )
-                    )
-                else:
-                    stage_elapsed = _format_duration(time.time() - current_stage_start_at)
-                    total_elapsed = _format_duration(time.time() - workflow_start_at)
-                    done_tip = message or "处理完成"
-                    status_box.success(
-                        f"✅ {stage_name} 完成（阶段 {stage_elapsed} / 总计 {total_elapsed}）\n\n{done_tip}"
-                    )
-                    current_stage_name = "等待下一阶段"
-                    current_stage_start_at = time.time()
-                    stage_mode = "排队中"
-                    stage_extra = "上一阶段已完成，准备进入下一阶段..."
-                continue
-
-            if event_type in {"token", "chunk", "assistant_token"}:
-                token = str(event.get("content", ""))
-                if token:
-                    assistant_text += token
-                    answer_box.markdown(assistant_text)
+            # 整批事件处理完只渲染一次
+            ctx.render()
 
-                current_stage_name = "生成回复"
-                stage_mode = "输出中"
-                stage_extra = "正在逐字生成答案..."
-                continue
-
-            if event_type in {"final", "done"}:
-                final_reply = str(event.get("assistant_reply", "")).strip()
-                if final_reply:
-                    assistant_text = final_reply
-                    answer_box.markdown(assistant_text)
+        ctx.flush_answer()
 
-                payload_state = event.get("state")
-                if isinstance(payload_state, dict):
-                    final_state = payload_state
-
-                current_stage_name = "结果收尾"
-                current_stage_start_at = time.time()
-                stage_mode = "完成中"
-                stage_extra = "正在保存本轮状态..."
-                continue
+        # 不再 join 等待：worker 是守护线程，发出 _worker_done 后即将结束；
+        # 提前退出循环（超时等）时通知它在下一批数据到达时自行收尾
+        worker_stop.set()
 
-        if worker_thread.is_alive():
-            worker_thread.join(timeout=1.0)
+        answer_box = ctx.answer_box
+        assistant_text = ctx.assistant_text
+        final_state = ctx.final_state
+        runtime_error = ctx.runtime_error
 
         total_elapsed = _format_duration(time.time() - workflow_start_at)
 
@@ -472,13 +795,13 @@ if user_text:
                 assistant_text = f"{assistant_text}\n\n（注意：{runtime_error}）"
             else:
                 assistant_text = f"请求失败: {runtime_error}"
-            status_box.error(f"❌ 本轮处理失败（总耗时 {total_elapsed}）")
+            status.update(label=f"❌ 本轮处理失败（总耗时 {total_elapsed}）", state="error")
             answer_box.markdown(assistant_text)
         else:
             if not assistant_text.strip():
                 assistant_text = "抱歉，本轮没有生成有效回复。"
                 answer_box.markdown(assistant_text)
-            status_box.success(f"✅ 本轮处理完成（总耗时 {total_elapsed}）")
+            status.update(label=f"✅ 本轮处理完成（总耗时 {total_elapsed}）", state="complete", expanded=False)
 
     st.session_state.messages.append({"role": "assistant", "content": assistant_text})
 